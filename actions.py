@@ -0,0 +1,50 @@
+import json
+from typing import Any, Callable, Dict, Iterable, Tuple
+
+import codec
+from message import Message
+
+# carried out by the chat ui, `ChatBox.perform_{action}`
+PUSH_TEXT = "push_text"
+CLEAR_CHAT = "clear_chat"
+CONNECTION_ENABLE = "connection_enable"
+CONNECTION_DISABLE = "connection_disable"
+UI_ACTIONS = (PUSH_TEXT, CLEAR_CHAT, CONNECTION_ENABLE, CONNECTION_DISABLE)
+# the state of the connection, only queued by a `WsClient` asked for them
+CONNECTION_ACTIONS = (CONNECTION_ENABLE, CONNECTION_DISABLE)
+
+# carried out by the server for the client that sent them
+JOIN = "join"
+LEAVE = "leave"
+ATTACH = "attach"
+DETACH = "detach"
+
+# (codec key, action) -> encoded control frame
+_frames: Dict[Tuple[str, str], codec.Frame] = {}
+
+
+def handlers(target: Any, names: Iterable[str] = UI_ACTIONS, prefix: str = "perform_") -> Dict[str, Callable]:
+    """
+    The `{prefix}{name}` methods of `target` by action name. Looked up
+    once, dispatch is then a dict get and an action outside `names` has
+    nothing to run
+    """
+    return {name: getattr(target, prefix + name) for name in names}
+
+
+def control_frame(name: str, wire: codec.Codec) -> codec.Frame:
+    """
+    A ui action with no payload encoded for `wire`, once per codec. Json
+    frames carry only the action, the other fields decode to their defaults
+    """
+    if name not in UI_ACTIONS:
+        raise ValueError(f'unknown action: {name}')
+    key = (wire.key, name)
+    data = _frames.get(key)
+    if data is None:
+        if wire.binary:
+            data = wire.encode(Message(action=name))
+        else:
+            data = json.dumps({"action": name})
+        _frames[key] = data
+    return data
@@ -0,0 +1,202 @@
+import os
+import fcntl
+import struct
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional, Set
+
+from message import Message
+
+OnMessage = Callable[[Message], Awaitable[None]]
+
+# workers publish frames of a 4 byte big endian length and a json message,
+# the broker delivers them with the message_id it assigned after the length
+FRAME_HEADER = struct.Struct("!I")
+DELIVERY_HEADER = struct.Struct("!IQ")
+
+
+class Backplane(object):
+    """
+    Pub/sub transport between server workers, every published message is
+    handed to `on_message` of every worker, the publisher included, with
+    a message_id following the last one assigned
+    """
+
+    def __init__(self):
+        self.on_message: Optional[OnMessage] = None
+        self.last_id: Callable[[], int] = lambda: 0
+
+    @property
+    def is_broker(self) -> bool:
+        """
+        The broker assigns message ids, its worker keeps the message log
+        """
+        return True
+
+    async def start(self, on_message: OnMessage, last_id: Optional[Callable[[], int]] = None):
+        self.on_message = on_message
+        if last_id:
+            self.last_id = last_id
+
+    async def publish(self, message: Message):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class LocalBackplane(Backplane):
+    """
+    Single worker, messages go straight back to the local connections
+    """
+
+    async def start(self, on_message: OnMessage, last_id: Optional[Callable[[], int]] = None):
+        await super().start(on_message, last_id)
+        self.next_id = self.last_id() + 1
+
+    async def publish(self, message: Message):
+        message.message_id = self.next_id
+        self.next_id += 1
+        await self.on_message(message)
+
+
+class UnixSocketBackplane(Backplane):
+    """
+    Workers on one box meet on a unix socket. Whichever worker holds the
+    lock file runs the broker, the others connect to it and take over
+    when its process dies
+    """
+
+    def __init__(self, path: str, **kwargs):
+        super().__init__()
+        self.path = path
+        self.lock_path = path + '.lock'
+        self.retry_time = kwargs.get('retry_time', 0.2)
+        # a peer with this many unsent bytes in the broker gets dropped
+        self.peer_buffer_limit = kwargs.get('peer_buffer_limit', 64 * 1024 * 1024)
+        self.next_id = 1
+        self.lock_fd: Optional[int] = None
+        self.broker: Optional[asyncio.AbstractServer] = None
+        self.peers: Set[asyncio.StreamWriter] = set()
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.connected = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def is_broker(self) -> bool:
+        return self.broker is not None
+
+    async def start(self, on_message: OnMessage, last_id: Optional[Callable[[], int]] = None):
+        await super().start(on_message, last_id)
+        self.task = asyncio.ensure_future(self.run())
+        await self.connected.wait()
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        if self.writer:
+            self.writer.close()
+        if self.broker:
+            self.broker.close()
+            for peer in list(self.peers):
+                peer.close()
+            self.broker = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
+
+    async def publish(self, message: Message):
+        if not self.connected.is_set():
+            await self.connected.wait()
+        data = message.json().encode()
+        self.writer.write(FRAME_HEADER.pack(len(data)) + data)
+        await self.writer.drain()
+
+    async def run(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if not await self.become_broker():
+                    await asyncio.sleep(self.retry_time)
+                continue
+
+            self.writer = writer
+            self.connected.set()
+            try:
+                while True:
+                    header = await reader.readexactly(DELIVERY_HEADER.size)
+                    length, message_id = DELIVERY_HEADER.unpack(header)
+                    message = Message.from_json(await reader.readexactly(length))
+                    message.message_id = message_id
+                    try:
+                        await self.on_message(message)
+                    except Exception:
+                        # one failed delivery must not stop the reader
+                        logging.exception(f'delivering message {message_id} failed')
+            except (asyncio.IncompleteReadError, ConnectionError) as err:
+                logging.warning(f'backplane connection lost: {err}')
+            finally:
+                self.connected.clear()
+                self.writer = None
+                writer.close()
+            await asyncio.sleep(self.retry_time)
+
+    async def become_broker(self) -> bool:
+        if self.lock_fd is None:
+            fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # another worker is the broker, or is about to be
+                os.close(fd)
+                return False
+            self.lock_fd = fd
+
+        if self.broker is None:
+            if os.path.exists(self.path):
+                # left behind by a broker that died
+                os.unlink(self.path)
+            self.next_id = self.last_id() + 1
+            self.broker = await asyncio.start_unix_server(self.handle_peer, self.path)
+            logging.info(f'backplane broker listening on {self.path}')
+        return True
+
+    async def handle_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.peers.add(writer)
+        try:
+            while True:
+                data = await read_frame(reader)
+                frame = DELIVERY_HEADER.pack(len(data), self.next_id) + data
+                self.next_id += 1
+                for peer in list(self.peers):
+                    if peer.transport.get_write_buffer_size() > self.peer_buffer_limit:
+                        logging.warning('backplane peer is not draining, dropping it')
+                        self.peers.discard(peer)
+                        peer.close()
+                        continue
+                    peer.write(frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.peers.discard(writer)
+            writer.close()
+
+
+async def read_frame(reader: asyncio.StreamReader) -> bytes:
+    header = await reader.readexactly(FRAME_HEADER.size)
+    (length,) = FRAME_HEADER.unpack(header)
+    return await reader.readexactly(length)
+
+
+def from_env() -> Backplane:
+    """
+    CHAT_BACKPLANE=/path/to.sock shares messages between uvicorn workers
+    """
+    path = os.environ.get('CHAT_BACKPLANE')
+    if path:
+        return UnixSocketBackplane(path)
+    return LocalBackplane()
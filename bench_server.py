@@ -0,0 +1,303 @@
+"""
+Headless load generator for server.py
+
+Starts the app with uvicorn in a child process, connects simulated users
+with WsClient spread over a few event loops, sends at a fixed rate and
+reports throughput, end-to-end latency, connect time and server RSS.
+
+    python bench_server.py --users 200 --loops 2 --rate 2 --duration 20
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.request
+from typing import Dict, List
+
+from message import Message
+from client import WsClient
+import codec
+
+PROTOCOLS = {
+    "binary-batch": [codec.BINARY_BATCH_PROTOCOL],
+    "binary": [codec.BINARY_PROTOCOL],
+    "json-batch": [codec.JSON_BATCH_PROTOCOL],
+    "json": [codec.JSON_PROTOCOL],
+}
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = max(int(round(pct / 100 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def process_tree(pid: int) -> List[int]:
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # the command may hold spaces, the parent pid follows its closing paren
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    pids, todo = [], [pid]
+    while todo:
+        current = todo.pop()
+        pids.append(current)
+        todo.extend(children.get(current, []))
+    return pids
+
+
+def rss_bytes(pid: int) -> int:
+    """
+    Resident memory of a process and its children, uvicorn workers included
+    """
+    total = 0
+    for current in process_tree(pid):
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+
+class Server(object):
+    """
+    server.py under uvicorn in a child process
+    """
+
+    def __init__(self, port: int, workers: int, rate_limit: float = 0):
+        self.port = port
+        self.workers = workers
+        # messages a second per user, 0 lets the load through unlimited
+        self.rate_limit = rate_limit
+        self.tmp = tempfile.TemporaryDirectory(prefix='chat-bench-')
+        self.process = None
+
+    def start(self, timeout: float = 20):
+        env = dict(os.environ)
+        env['CHAT_HISTORY_DIR'] = os.path.join(self.tmp.name, 'history')
+        env['CHAT_RATE'] = str(self.rate_limit)
+        env['CHAT_BURST'] = str(self.rate_limit * 2)
+        env['CHAT_TOKEN_RATE'] = '0'
+        if self.workers > 1:
+            env['CHAT_BACKPLANE'] = os.path.join(self.tmp.name, 'backplane.sock')
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'server:app', '--host', '127.0.0.1',
+             '--port', str(self.port), '--workers', str(self.workers), '--log-level', 'warning'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+            stdout=subprocess.DEVNULL,
+        )
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=0.2).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError(f'server did not listen on port {self.port} within {timeout}s')
+
+    def limited(self) -> int:
+        """
+        Messages the rate limit dropped, of the worker that answers the
+        scrape when there are several
+        """
+        with urllib.request.urlopen(f'http://127.0.0.1:{self.port}/metrics', timeout=5) as response:
+            for line in response.read().decode().splitlines():
+                if line.startswith('chat_messages_limited_total '):
+                    return int(line.split()[1])
+        return 0
+
+    def rss(self) -> int:
+        return rss_bytes(self.process.pid)
+
+    def stop(self):
+        if self.process:
+            self.process.terminate()
+            self.process.wait(timeout=10)
+        self.tmp.cleanup()
+
+
+class LoadLoop(object):
+    """
+    One event loop in its own thread driving a share of the users
+    """
+
+    def __init__(self, args, users: List[str]):
+        self.args = args
+        self.users = users
+        self.loop = asyncio.new_event_loop()
+        self.connect_times: List[float] = []
+        self.latencies: List[float] = []
+        self.sent = 0
+        self.received = 0
+        self.reconnects = 0
+        self.thread = threading.Thread(target=self.run)
+
+    def url(self, user: str) -> str:
+        url = f'ws://127.0.0.1:{self.args.port}/ws/{user}?token=bench'
+        if self.args.room_size:
+            url += f'&room={self.room(user)}'
+        return url
+
+    def room(self, user: str) -> str:
+        return f'room{int(user[4:]) // self.args.room_size}'
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.main())
+        self.loop.close()
+
+    async def main(self):
+        clients = [
+            WsClient(user, self.url(user), loop=self.loop,
+                     subprotocols=PROTOCOLS[self.args.protocol])
+            for user in self.users
+        ]
+        tasks = [asyncio.ensure_future(client.repl()) for client in clients]
+        tasks += [asyncio.ensure_future(self.user(client)) for client in clients]
+        await asyncio.sleep(self.args.duration + self.args.connect_timeout + self.args.drain)
+        self.reconnects = sum(client.reconnects for client in clients)
+        # the clients' own send and receive tasks go too
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def user(self, client: WsClient):
+        connect_started = time.perf_counter()
+        while not client.connected:
+            if time.perf_counter() - connect_started > self.args.connect_timeout:
+                return
+            await asyncio.sleep(0.001)
+        self.connect_times.append(time.perf_counter() - connect_started)
+
+        receiver = asyncio.ensure_future(self.receive(client))
+        interval = 1.0 / self.args.rate
+        # spread the first sends so users do not fire in lockstep
+        await asyncio.sleep(interval * (hash(client.user_name) % 1000) / 1000)
+        deadline = time.perf_counter() + self.args.duration
+        seq = 0
+        while time.perf_counter() < deadline:
+            msg = Message(sender=client.user_name, text=f'bench {seq} {time.perf_counter_ns()}',
+                          created_at=int(time.time()))
+            if self.args.room_size:
+                msg.room = self.room(client.user_name)
+            await client.asend(msg)
+            self.sent += 1
+            seq += 1
+            await asyncio.sleep(interval)
+        await asyncio.sleep(self.args.drain)
+        receiver.cancel()
+
+    async def receive(self, client: WsClient):
+        # the server echoes every chat line to its sender as "#user:text"
+        echo_prefix = f'#{client.user_name}:bench '
+        while True:
+            msg = await client.arecv()
+            if msg.sender == "Bot":
+                continue
+            self.received += 1
+            if msg.text.startswith(echo_prefix):
+                sent_ns = int(msg.text.rsplit(' ', 1)[1])
+                self.latencies.append((time.perf_counter_ns() - sent_ns) / 1e6)
+
+
+def run(args) -> Dict:
+    server = Server(args.port, args.workers, args.rate_limit)
+    server.start()
+    rss_start = server.rss()
+    rss_peak = rss_start
+    try:
+        users = [f'user{i}' for i in range(args.users)]
+        loops = [LoadLoop(args, users[i::args.loops]) for i in range(args.loops)]
+        for load in loops:
+            load.thread.start()
+        while any(load.thread.is_alive() for load in loops):
+            rss_peak = max(rss_peak, server.rss())
+            time.sleep(0.5)
+        rss_end = server.rss()
+        limited = server.limited()
+    finally:
+        server.stop()
+
+    connect_times = [t * 1e3 for load in loops for t in load.connect_times]
+    latencies = [t for load in loops for t in load.latencies]
+    sent = sum(load.sent for load in loops)
+    received = sum(load.received for load in loops)
+    return {
+        "config": vars(args),
+        "results": {
+            "connected": len(connect_times),
+            "connect_ms": {
+                "p50": percentile(connect_times, 50),
+                "p99": percentile(connect_times, 99),
+                "max": max(connect_times, default=0.0),
+            },
+            "sent": sent,
+            "received": received,
+            "sent_per_sec": sent / args.duration,
+            "received_per_sec": received / args.duration,
+            "limited": limited,
+            # sent but not echoed, leaving out what the rate limit dropped
+            "echo_lost": max(sent - limited - len(latencies), 0),
+            "reconnects": sum(load.reconnects for load in loops),
+            "latency_ms": {
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                "max": max(latencies, default=0.0),
+            },
+            "server_rss_bytes": {
+                "start": rss_start,
+                "peak": rss_peak,
+                "end": rss_end,
+            },
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='server load benchmark')
+    parser.add_argument('--users', type=int, default=50, help='simulated users')
+    parser.add_argument('--loops', type=int, default=1, help='event loops the users share')
+    parser.add_argument('--rate', type=float, default=1.0, help='messages per second per user')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of sending')
+    parser.add_argument('--room-size', type=int, default=0,
+                        help='users per room, 0 puts everyone in the global broadcast')
+    parser.add_argument('--protocol', choices=list(PROTOCOLS), default='binary-batch')
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help="the server's messages per second per user, 0 turns the limit off")
+    parser.add_argument('--workers', type=int, default=1, help='uvicorn worker processes')
+    parser.add_argument('--port', type=int, default=5599)
+    parser.add_argument('--connect-timeout', type=float, default=10.0)
+    parser.add_argument('--drain', type=float, default=2.0,
+                        help='seconds to wait for in-flight messages after sending stops')
+    parser.add_argument('--output', default='bench_output.json', help='json results file')
+    args = parser.parse_args()
+
+    report = run(args)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report["results"], indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+"""
+Headless render benchmark for chat_box.py
+
+Runs ChatBox without a terminal: a driver that only reports a fixed size,
+the screen output counted and thrown away, and a synthetic source in place
+of WsClient that feeds it messages from many senders. Reports ingest
+throughput, the time to apply each frame's batch and to paint it, and how
+much the process grew.
+
+    python bench_tui.py --messages 20000 --senders 20 --rate 2000
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import contextlib
+from typing import Dict, List, Optional
+
+from textual import events
+from textual.driver import Driver
+from textual.geometry import Size
+
+from message import Message
+from bench_server import percentile, rss_bytes
+
+
+class HeadlessDriver(Driver):
+    """
+    No terminal, no input, a single resize to the console's size
+    """
+
+    def start_application_mode(self):
+        width, height = self.console.size
+        self._target.post_message_no_wait(events.Resize(self._target, Size(width, height)))
+
+    def disable_input(self):
+        pass
+
+    def stop_application_mode(self):
+        pass
+
+
+class Sink(object):
+    """
+    Stands in for the terminal, keeps only the number of bytes written
+    """
+
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, data: str) -> int:
+        self.bytes += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def isatty(self) -> bool:
+        return True
+
+
+class SyntheticSource(object):
+    """
+    What ChatBox reads from `WsClient`, fed `count` messages from `senders`
+    users at `rate` messages per second, all at once with a rate of 0
+    """
+
+    def __init__(self, count: int, senders: int, rate: float, text_size: int):
+        self.count = count
+        self.senders = senders
+        self.rate = rate
+        self.text_size = text_size
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.produced = 0
+        self.finished_at: Optional[float] = None
+        self.last_message_id = None
+
+    def message(self, seq: int) -> Message:
+        text = f'message {seq} '
+        return Message(
+            sender=f'user{seq % self.senders}',
+            text=(text * (self.text_size // len(text) + 1))[:self.text_size],
+            created_at=int(time.time()),
+            message_id=seq + 1,
+        )
+
+    async def produce(self):
+        started = time.perf_counter()
+        while True:
+            due = self.count if not self.rate else int((time.perf_counter() - started) * self.rate) + 1
+            while self.produced < min(due, self.count):
+                self.queue.put_nowait(self.message(self.produced))
+                self.produced += 1
+            if self.produced == self.count:
+                break
+            await asyncio.sleep(0.005)
+        self.finished_at = time.perf_counter()
+
+    async def arecv(self) -> Message:
+        return await self.queue.get()
+
+    def recv(self) -> Optional[Message]:
+        try:
+            return self.queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return None
+
+    async def asend(self, msg: Message) -> bool:
+        return True
+
+    def stop(self):
+        pass
+
+
+def headless_app(user: str, max_fps: int):
+    # imported once the console environment is set
+    from chat_box import ChatBox
+
+    class HeadlessChatBox(ChatBox):
+        """
+        ChatBox timing every batch it applies and every paint
+        """
+
+        def __init__(self, *kargs, **kwargs):
+            self.flush_ms: List[float] = []
+            self.batch_sizes: List[int] = []
+            self.paint_ms: List[float] = []
+            self.applied = 0
+            self.applied_at = 0.0
+            super().__init__(*kargs, **kwargs)
+
+        async def on_flush_messages(self, messages: List[Message]):
+            started = time.perf_counter()
+            await super().on_flush_messages(messages)
+            self.flush_ms.append((time.perf_counter() - started) * 1e3)
+            self.batch_sizes.append(len(messages))
+            self.applied += len(messages)
+            self.applied_at = time.perf_counter()
+
+        def refresh(self, repaint: bool = True, layout: bool = False) -> None:
+            started = time.perf_counter()
+            super().refresh(repaint, layout)
+            self.paint_ms.append((time.perf_counter() - started) * 1e3)
+
+        def display(self, renderable) -> None:
+            started = time.perf_counter()
+            super().display(renderable)
+            self.paint_ms.append((time.perf_counter() - started) * 1e3)
+
+    return HeadlessChatBox(user, 'ws://headless', driver_class=HeadlessDriver, max_fps=max_fps)
+
+
+def summary(values: List[float]) -> Dict:
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values, default=0.0),
+    }
+
+
+async def bench(args, sink: Sink) -> Dict:
+    app = headless_app('bench', args.max_fps)
+    source = SyntheticSource(args.messages, args.senders, args.rate, args.text_size)
+    app.cli = source
+
+    ui = asyncio.ensure_future(app.process_messages())
+    # on_mount has built the layout once the help layer exists
+    while not hasattr(app, 'help_hint'):
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(args.settle)
+    del app.paint_ms[:]
+    sink.bytes = 0
+
+    pid = os.getpid()
+    rss_start = rss_peak = rss_bytes(pid)
+    started = time.perf_counter()
+    listener = asyncio.ensure_future(app.server_listen())
+    producer = asyncio.ensure_future(source.produce())
+    while app.applied < args.messages:
+        rss_peak = max(rss_peak, rss_bytes(pid))
+        await asyncio.sleep(0.05)
+    finished = app.applied_at
+    # paints the last frame asked for
+    await asyncio.sleep(args.settle)
+    rss_end = rss_bytes(pid)
+
+    listener.cancel()
+    await app.shutdown()
+    await asyncio.gather(ui, listener, producer, return_exceptions=True)
+    app.cache.close()
+
+    elapsed = finished - started
+    return {
+        "config": vars(args),
+        "results": {
+            "messages": app.applied,
+            "seconds": elapsed,
+            "ingest_per_sec": app.applied / elapsed if elapsed else 0.0,
+            # how long the screen trailed the source once it stopped
+            "drain_seconds": finished - (source.finished_at or finished),
+            "frames": len(app.flush_ms),
+            "messages_per_frame": app.applied / max(len(app.flush_ms), 1),
+            "flush_ms": summary(app.flush_ms),
+            "paints": len(app.paint_ms),
+            "paint_ms": summary(app.paint_ms),
+            "terminal_bytes": sink.bytes,
+            "rss_bytes": {
+                "start": rss_start,
+                "peak": rss_peak,
+                "end": rss_end,
+                "growth": rss_end - rss_start,
+            },
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='chat ui render benchmark')
+    parser.add_argument('--messages', type=int, default=10000, help='messages to feed the ui')
+    parser.add_argument('--senders', type=int, default=10, help='distinct users sending them')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='messages per second, 0 queues them all at once')
+    parser.add_argument('--text-size', type=int, default=60, help='characters per message')
+    parser.add_argument('--max-fps', type=int, default=30, help='ChatBox frame rate cap')
+    parser.add_argument('--width', type=int, default=160, help='terminal columns')
+    parser.add_argument('--height', type=int, default=50, help='terminal lines')
+    parser.add_argument('--settle', type=float, default=0.5,
+                        help='seconds to let the ui paint before and after feeding it')
+    parser.add_argument('--output', default='bench_tui_output.json', help='json results file')
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory(prefix='chat-bench-tui-')
+    os.environ.update({
+        'COLUMNS': str(args.width),
+        'LINES': str(args.height),
+        # paint with colors as a terminal would get them
+        'FORCE_COLOR': '1',
+        'TERM': 'xterm-256color',
+        'CHAT_CACHE_DIR': tmp.name,
+    })
+    sink = Sink()
+    try:
+        with contextlib.redirect_stdout(sink):
+            report = asyncio.get_event_loop().run_until_complete(bench(args, sink))
+    finally:
+        tmp.cleanup()
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report["results"], indent=2))
+
+
+if __name__ == '__main__':
+    main()
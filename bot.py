@@ -0,0 +1,131 @@
+import time
+import asyncio
+import logging
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from message import Message
+import metrics
+
+OnReply = Callable[[Message], Awaitable[None]]
+
+
+class BotHandler(object):
+    """
+    Computes bot replies. `reply` runs on a worker thread or process, so it
+    may block as long as it likes without stalling other sockets. Handlers
+    used with a process pool have to be picklable
+    """
+
+    name = "Bot"
+    # replies computed at once for this bot, the rest wait their turn
+    max_concurrency = 4
+    # messages allowed to wait for a free slot before the bot reports busy
+    max_pending = 64
+    # seconds until a reply is given up on
+    timeout = 10.0
+
+    def reply(self, message: Message) -> Optional[str]:
+        raise NotImplementedError
+
+
+class EchoBot(BotHandler):
+    def reply(self, message: Message) -> Optional[str]:
+        return 'reply: ' + message.text
+
+
+def _run_handler(handler: BotHandler, message: Message) -> Optional[str]:
+    # module level so process pools can pickle it
+    return handler.reply(message)
+
+
+class BotEngine(object):
+    """
+    Runs bot handlers off the event loop and posts their replies back
+    """
+
+    def __init__(self, **kwargs):
+        self.executor_type = kwargs.get('executor', 'thread')
+        self.max_workers = kwargs.get('max_workers', 4)
+        self.executor = self._make_executor()
+        self.handlers: Dict[str, BotHandler] = {}
+        self.slots: Dict[str, asyncio.Semaphore] = {}
+        self.pending: Dict[str, int] = {}
+        self.default: Optional[str] = None
+
+    def _make_executor(self) -> Executor:
+        if self.executor_type == 'thread':
+            return ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='bot')
+        if self.executor_type == 'process':
+            return ProcessPoolExecutor(max_workers=self.max_workers)
+        raise ValueError(f'unknown executor type: {self.executor_type}')
+
+    def register(self, handler: BotHandler, default: bool = False):
+        self.handlers[handler.name] = handler
+        self.pending[handler.name] = 0
+        if default or self.default is None:
+            self.default = handler.name
+
+    def handlers_for(self, message: Message) -> List[BotHandler]:
+        """
+        Bots named in the recipients, or the default bot
+        """
+        names = [name for name in (message.reciepents or []) if name in self.handlers]
+        if not names and self.default:
+            names = [self.default]
+        return [self.handlers[name] for name in names]
+
+    def dispatch(self, message: Message, on_reply: OnReply):
+        """
+        Schedule the replies and return at once
+        """
+        for handler in self.handlers_for(message):
+            asyncio.ensure_future(self.run(handler, message, on_reply))
+
+    async def run(self, handler: BotHandler, message: Message, on_reply: OnReply):
+        started = time.perf_counter()
+        if self.pending[handler.name] >= handler.max_pending:
+            await on_reply(self._reply(handler, f'{handler.name} is busy, try again later'))
+            return
+
+        slots = self.slots.get(handler.name)
+        if slots is None:
+            # created lazily to bind to the running loop
+            slots = self.slots[handler.name] = asyncio.Semaphore(handler.max_concurrency)
+
+        self.pending[handler.name] += 1
+        try:
+            await slots.acquire()
+        finally:
+            self.pending[handler.name] -= 1
+
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(self.executor, _run_handler, handler, message)
+        future.add_done_callback(lambda done: self._release(slots, done))
+        try:
+            text = await asyncio.wait_for(asyncio.shield(future), timeout=handler.timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f'{handler.name} timed out after {handler.timeout}s')
+            text = f'{handler.name} took too long to answer'
+        except Exception as err:
+            logging.exception(err)
+            return
+
+        metrics.bot_reply_seconds.observe(time.perf_counter() - started, handler.name)
+        if text is not None:
+            await on_reply(self._reply(handler, text))
+
+    @staticmethod
+    def _release(slots: asyncio.Semaphore, future: asyncio.Future):
+        # a timed out reply keeps its slot until the worker really finishes,
+        # its late result or error is dropped here
+        slots.release()
+        if not future.cancelled():
+            future.exception()
+
+    @staticmethod
+    def _reply(handler: BotHandler, text: str) -> Message:
+        return Message(sender=handler.name, text=text, created_at=int(time.time()))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -1,18 +1,19 @@
 import os
 import time
 import asyncio
-from collections import defaultdict
+from collections import defaultdict, deque
 from copy import deepcopy
-from typing import List, Any, Dict, Optional
+from typing import List, Any, Deque, Dict, Optional, Tuple
 
 from rich.align import Align
 from rich.text import Text
+from rich.tree import Tree
 from rich.console import RenderableType
 
 from textual import events
 from textual.app import App
-from textual.layouts.dock import DockLayout
 from textual.widgets import ScrollView, TreeClick, Static, TreeControl, TreeNode, Header, Placeholder
+from textual.widgets._tree_control import NodeID
 from textual.widget import Widget
 from rich.table import Table
 from rich.console import RenderableType
@@ -22,6 +23,8 @@ from textual_inputs import IntegerInput, TextInput
 
 from message import Message
 from client import WsClient
+import actions
+from chat_cache import ChatCache, default_path
 
 BotList = ["Alice", "Dian"]
 
@@ -46,19 +49,35 @@ f"""
     talk with {link_colored(botname, "#", "green")}
 """
 
+HELP_BANNER = """
+        ┬ ┬┌─┐┬  ┌─┐  ┌┬┐┌─┐┌┐┌┬ ┬
+        ├─┤├┤ │  ├─┘  │││├┤ ││││ │
+        ┴ ┴└─┘┴─┘┴    ┴ ┴└─┘┘└┘└─┘
+        """
+
 class ChatScreen(TreeControl):
     """
-    A screen for providing chats
+    A screen for providing chats. Only a window of at most `max_live`
+    messages has tree nodes, the rest waits in a ring buffer of the last
+    `history_size` messages and gets nodes again when paged in
     """
     # colors: https://rich.readthedocs.io/en/stable/appendix/colors.html
     SysColor = "dark_red"
     TextColor = [SysColor, "bright_green", "bright_blue", "navy_blue", "dark_cyan", "purple4"]
     UserNameColor = [SysColor, "plum4", "medium_orchid", "purple", "rosy_brown", "dark_khaki"]
     TimeColor = "bright_black"
+    # logs every line painted, slow, for debugging only
+    LogRender = bool(os.environ.get('CHAT_LOG_RENDER'))
 
-    def __init__(self, name: str = "", user: str = ""):
+    def __init__(self, name: str = "", user: str = "", max_live: int = 200, history_size: int = 10000):
         super().__init__(name, name)
-        self.msgs = []
+        self.max_live = max_live
+        self.msgs: Deque[Message] = deque(maxlen=history_size)
+        # msgs[first_live:last_live] have nodes, in order
+        self.first_live = 0
+        self.last_live = 0
+        # node id -> the state it was rendered in and the rendered line
+        self.line_cache: Dict[NodeID, Tuple[tuple, Text]] = {}
         self.user = user
         self.user_colors_index_dict = {}
         self.user_colors_idx = 0
@@ -81,47 +100,150 @@ class ChatScreen(TreeControl):
         self._get_user_color_index(user)
 
     def render_node(self, node: TreeNode) -> RenderableType:
-        meta = {
-            "@click": f"click_label({node.id})",
-            "tree_node": node.id,
-            "cursor": node.is_cursor,
-        }
-        self.log(node.label, node.data)
+        # a line only changes with the hover, the cursor or the user
+        state = (node.id == self.hover_node, node.is_cursor, self.user)
+        cached = self.line_cache.get(node.id)
+        if cached and cached[0] == state:
+            return cached[1]
+
+        if self.LogRender:
+            self.log(node.label, node.data)
         msg = node.data
-        if msg:
+        if isinstance(msg, Message):
             sender = msg.sender
-            color_idx = self._get_user_color_index(sender)
+            color_idx = self._get_user_color_index(sender) % len(self.TextColor)
             time_str = msg.send_time
+            text_style = self.TextColor[color_idx]
+            name_style = self.UserNameColor[color_idx]
+            # assembled from styled parts, so markup in the text shows as typed
             if sender == self.user:
-                align = "right"
-                label = f"[{self.TimeColor}]{time_str} [{self.TextColor[color_idx]}]{msg.text} :[{self.UserNameColor[color_idx]}]{sender}"
+                label = Text.assemble(
+                    (f"{time_str} ", self.TimeColor), (f"{msg.text} :", text_style), (sender, name_style),
+                    justify="right",
+                )
             else:
-                align = "left"
-                label = f"[{self.UserNameColor[color_idx]}]{sender}: [{self.TextColor[color_idx]}]{msg.text} [{self.TimeColor}]{time_str}"
+                label = Text.assemble(
+                    (f"{sender}: ", name_style), (f"{msg.text} ", text_style), (time_str, self.TimeColor),
+                    justify="left",
+                )
         else:
-            align = "left"
-            label = node.label
+            label = Text.from_markup(node.label, justify="left")
 
-        label = Text.from_markup(label, justify=align)
-        if node.id == self.hover_node:
+        if state[0]:
             label.stylize("bold")
-
-        label.apply_meta(meta)
-
+        label.apply_meta({
+            "@click": f"click_label({node.id})",
+            "tree_node": node.id,
+            "cursor": state[1],
+        })
+        self.line_cache[node.id] = (state, label)
         return label
 
     async def clear_chat(self):
         self.root.children.clear()
         self.root.tree.children.clear()
+        self.nodes = {self.root.id: self.root}
+        self.line_cache.clear()
+        self.msgs.clear()
+        self.first_live = self.last_live = 0
         self.refresh()
 
-    async def push_text(self, msg: Message) -> None:
+    @property
+    def following(self) -> bool:
+        """
+        Whether the newest message is on screen, new ones then get nodes
+        """
+        return self.last_live == len(self.msgs)
+
+    async def push_text(self, msg: Message, refresh: bool = True) -> None:
         if not self.root.expanded:
             await self.root.expand()
 
+        following = self.following
+        if len(self.msgs) == self.msgs.maxlen:
+            # the ring drops its oldest message, indexes shift down by one
+            if self.first_live > 0:
+                self.first_live -= 1
+            elif self.last_live > 0:
+                self._drop_node(0)
+            self.last_live = max(self.last_live - 1, 0)
         self.msgs.append(msg)
-        await self.root.add("", msg)
-        self.refresh()
+        if not following:
+            if self.last_live == self.first_live:
+                # the ring dropped the whole window, show the newest again
+                self.follow()
+            return
+
+        self._add_node(msg)
+        self.last_live += 1
+        while self.last_live - self.first_live > self.max_live:
+            self._drop_node(0)
+            self.first_live += 1
+        if refresh:
+            self.refresh(layout=True)
+
+    def show_older(self, count: Optional[int] = None) -> int:
+        """
+        Give nodes to up to `count` messages before the window, the newest
+        ones lose theirs to keep it at `max_live`. Returns how many were added
+        """
+        count = min(count or self.max_live // 2, self.first_live)
+        for msg in reversed([self.msgs[i] for i in range(self.first_live - count, self.first_live)]):
+            self._add_node(msg, front=True)
+        self.first_live -= count
+        while self.last_live - self.first_live > self.max_live:
+            self._drop_node(-1)
+            self.last_live -= 1
+        if count:
+            self.refresh(layout=True)
+        return count
+
+    def prepend(self, msgs: List[Message]) -> int:
+        """
+        Put older messages, oldest first, in front of the ring as far as
+        it has room. Returns how many fit
+        """
+        count = min(len(msgs), self.msgs.maxlen - len(self.msgs))
+        if count:
+            self.msgs.extendleft(reversed(msgs[len(msgs) - count:]))
+            self.first_live += count
+            self.last_live += count
+        return count
+
+    def follow(self):
+        """
+        Move the window back to the newest messages
+        """
+        if self.following:
+            return
+        for _ in range(self.last_live - self.first_live):
+            self._drop_node(-1)
+        self.last_live = len(self.msgs)
+        self.first_live = max(self.last_live - self.max_live, 0)
+        for i in range(self.first_live, self.last_live):
+            self._add_node(self.msgs[i])
+        self.refresh(layout=True)
+
+    def _add_node(self, msg: Message, front: bool = False):
+        self.id = NodeID(self.id + 1)
+        tree = Tree("")
+        node = TreeNode(self.root, self.id, self, tree, "", msg)
+        tree.label = node
+        self.nodes[self.id] = node
+        if front:
+            self.root.children.insert(0, node)
+            self.root.tree.children.insert(0, tree)
+        else:
+            self.root.children.append(node)
+            self.root.tree.children.append(tree)
+
+    def _drop_node(self, index: int):
+        node = self.root.children.pop(index)
+        self.root.tree.children.pop(index)
+        self.nodes.pop(node.id, None)
+        self.line_cache.pop(node.id, None)
+        if self.cursor == node.id:
+            self.cursor = self.root.id
 
 class Headbar(Header):
     """
@@ -177,6 +299,16 @@ def percent(percent, total):
     return int(percent * total / 100)
 
 
+class Separator(Widget):
+    """
+    A vertical rule drawn to the height the layout gives it
+    """
+
+    def render(self) -> RenderableType:
+        height = self.size.height
+        return Text("\n" * percent(10, height) + "┃\n" * percent(75, height))
+
+
 class ChatBox(App):
     """
     The UI Class for Gupshup
@@ -189,11 +321,20 @@ class ChatBox(App):
         *kargs,
         **kwargs,
     ) -> None:
+        # messages arriving faster than max_fps are drawn together, one update per frame
+        self.max_fps = kwargs.pop('max_fps', 30)
+        self.max_batch = kwargs.pop('max_batch', 500)
         super().__init__(*kargs, **kwargs)
         self.user = user
         self.ws_url = ws_url
+        # received messages, the server only replays what came after them
+        self.cache = ChatCache(default_path(user))
+        self.cache_offset = 0
+        # action name -> perform_ method, nothing else can be run by a message
+        self.actions = actions.handlers(self)
         # client related
-        self.cli = WsClient(self.user, self.ws_url)
+        self.cli = WsClient(self.user, self.ws_url, last_message_id=self.cache.last_message_id,
+                            connection_actions=True)
 
 
     @classmethod
@@ -212,9 +353,10 @@ class ChatBox(App):
             await app.process_messages()
 
         app = cls(user, ws_url, *kargs, **kwargs)
-        tasks = asyncio.wait([app.cli.repl(), app.server_listen(), run_ui(app)])
+        loop = asyncio.get_event_loop()
+        tasks = asyncio.wait([loop.create_task(coro) for coro in (app.cli.repl(), app.server_listen(), run_ui(app))])
         #asyncio.run(tasks)
-        asyncio.get_event_loop().run_until_complete(tasks)
+        loop.run_until_complete(tasks)
         
 
     async def on_load(self, _: events.Load) -> None:
@@ -237,37 +379,9 @@ class ChatBox(App):
             show=False,
         )
 
-    async def load_help_menu(self):
-        banner = """
-        ┬ ┬┌─┐┬  ┌─┐  ┌┬┐┌─┐┌┐┌┬ ┬
-        ├─┤├┤ │  ├─┘  │││├┤ ││││ │
-        ┴ ┴└─┘┴─┘┴    ┴ ┴└─┘┘└┘└─┘
-        """
-        await self._clear_screen()
-        await self.view.dock(
-            Static(Align.center(Text(banner, style="magenta"), vertical="middle")),
-            size=percent(20, os.get_terminal_size()[1]),
-        )
-        await self.view.dock(
-            Static(
-                Align.center(
-                    Text("-- Press ctrl+p to exit --", style="bold magenta"),
-                    vertical="middle",
-                )
-            ),
-            edge="bottom",
-            size=percent(10, os.get_terminal_size()[1]),
-        )
-        await self.view.dock(self.help_scroll)
-
     async def on_key(self, event: events.Key):
         if event.key == "ctrl+p":
-            if self.help_menu_loaded:
-                await self.refresh_screen()
-            else:
-                await self.load_help_menu()
-
-            self.help_menu_loaded = not self.help_menu_loaded
+            self.toggle_help()
             return
 
         if self.help_menu_loaded:
@@ -284,6 +398,32 @@ class ChatBox(App):
 
         if event.key == "enter":
             await self.action_send_message()
+        elif event.key == "pageup":
+            await self.action_page_older()
+        elif event.key == "pagedown":
+            await self.action_page_newer()
+
+    async def action_page_older(self):
+        screen = self.chat_screen[self.current_screen]
+        scroll = self.chat_scroll[self.current_screen]
+        if scroll.target_y > 0:
+            scroll.page_up()
+            return
+        # at the top of the window, older messages get their nodes now
+        if screen.first_live == 0 and self.cache_offset > 0 and len(screen.msgs) < screen.msgs.maxlen:
+            msgs, self.cache_offset = self.cache.read_before(self.cache_offset)
+            screen.prepend(msgs)
+        added = screen.show_older()
+        scroll.y = scroll.target_y = added
+
+    async def action_page_newer(self):
+        screen = self.chat_screen[self.current_screen]
+        scroll = self.chat_scroll[self.current_screen]
+        if scroll.target_y < scroll.max_scroll_y or screen.following:
+            scroll.page_down()
+            return
+        screen.follow()
+        await scroll.key_end()
 
     async def perform_connection_disable(self, *_) -> None:
         self.headbar.status = "ﮡ Can't connect"
@@ -312,12 +452,13 @@ class ChatBox(App):
         Executes the messages recieved from the server
         """
 
-        cmd = f"self.perform_{message.action}(message)"
-        await eval(cmd)
+        handler = self.actions.get(message.action)
+        if handler is None:
+            self.log(f"ignoring unknown action {message.action!r}")
+            return
+        await handler(message)
 
     async def on_mount(self, _: events.Mount) -> None:
-        y = os.get_terminal_size()[1]
-
         self.title = "ChatBox"
         self.headbar = Headbar()
         self.input_box = TextInput(
@@ -331,47 +472,37 @@ class ChatBox(App):
         self.chat_scroll = defaultdict(ScrollView)
 
         await self.populate_local_data()
-        await self.refresh_screen()
+        await self.build_layout()
         await self.input_box.focus()
 
     async def populate_local_data(self) -> None:
         """
-        Populates the app with offline data stored in the system
+        Populates the app with the newest page of the local cache, older
+        pages are read when scrolled to
         """
-
+        msgs, self.cache_offset = self.cache.tail()
+        screen = self.chat_screen[self.current_screen]
+        for msg in msgs:
+            await screen.push_text(msg, refresh=False)
         self.refresh()
 
-    async def on_resize(self, _: events.Resize) -> None:
-        await self.refresh_screen()
+    async def on_resize(self, event: events.Resize) -> None:
+        self.resize_layout(*event.size)
+        await super().on_resize(event)
 
     async def action_quit(self) -> None:
         """
-        Clean quit saving the data
+        Clean quit closing the local cache
         """
-#        self.client.save_chats()
-#        self.client.close_connection()
-
+        self.cache.close()
         await super().action_quit()
 
-    async def _clear_screen(self) -> None:
-        # clears all the widgets from the screen..and re render them all
-        # Why? you ask? this was the only way at the time of this writing
-
-        if isinstance(self.view.layout, DockLayout):
-            self.view.layout.docks.clear()
-        self.view.widgets.clear()
-
-    async def refresh_screen(self) -> None:
+    async def build_layout(self) -> None:
         """
-        Refresh the screen by repainting all the widgets
+        Dock every widget once, resizes only change their sizes and the
+        help menu is shown in place of the widgets below the header
         """
-
-        await self._clear_screen()
-        x, y = os.get_terminal_size()
-
-        rseperator = lseperator = "\n" * percent(10, y) + "┃\n" * percent(
-            75, y
-        )
+        x, y = self.console.size
 
         if self.current_screen not in self.chat_scroll:
             self.chat_screen[self.current_screen].set_user(self.user)
@@ -379,64 +510,64 @@ class ChatBox(App):
                 self.chat_screen[self.current_screen],
                 gutter=(0, 1),
             )
-
-        self.chat_scroll[self.current_screen].animate(
-            "y",
-            10**5,
-            # A large enough value to make sure it really scrolls down to the end
-            # ..will have to probably change this
-            easing="none",
-            speed=1000,
-        )
+        self.member_list = ScrollView()
+        self.house_tree = ScrollView()
 
         await self.view.dock(self.headbar, name="headbar")
         # RIGHT WIDGETS
-
-        await self.view.dock(
-            ScrollView(),
-            edge="right",
-            size=int(0.15 * x),
-            name="member_list",
-        )
-        await self.view.dock(
-            Static(rseperator),
-            edge="right",
-            size=1,
-            name="rs",
-        )
+        await self.view.dock(self.member_list, edge="right", name="member_list")
+        self.right_separator = Separator()
+        await self.view.dock(self.right_separator, edge="right", size=1, name="rs")
 
         # LEFT WIDGETS
-        await self.view.dock(
-            ScrollView(),
-            edge="left",
-            size=percent(20, x),
-            name="house_tree",
-        )
-        await self.view.dock(
-            Static(lseperator),
-            edge="left",
-            size=1,
-            name="ls",
-        )
+        await self.view.dock(self.house_tree, edge="left", name="house_tree")
+        self.left_separator = Separator()
+        await self.view.dock(self.left_separator, edge="left", size=1, name="ls")
 
         # MIDDLE WIDGETS
-        await self.view.dock(
-            self.banner,
-            size=percent(10, y),
-            name="banner",
+        await self.view.dock(self.banner, name="banner")
+        await self.view.dock(self.chat_scroll[self.current_screen], name="chat_screen")
+        await self.view.dock(self.input_box, name="input_box")
+
+        # HELP LAYER
+        self.help_banner = Static(Align.center(Text(HELP_BANNER, style="magenta"), vertical="middle"))
+        self.help_hint = Static(
+            Align.center(Text("-- Press ctrl+p to exit --", style="bold magenta"), vertical="middle")
         )
-        await self.view.dock(
-            self.chat_scroll[self.current_screen],
-            size=percent(75, y),
-            name="chat_screen",
+        for widget in (self.help_banner, self.help_hint, self.help_scroll):
+            widget.visible = False
+        await self.view.dock(self.help_banner, z=1)
+        await self.view.dock(self.help_hint, edge="bottom", z=1)
+        await self.view.dock(self.help_scroll, z=1)
+
+        self.resize_layout(x, y)
+        await self.chat_scroll[self.current_screen].key_end()
+
+    def resize_layout(self, x: int, y: int) -> None:
+        sizes = (
+            (self.member_list, int(0.15 * x)),
+            (self.house_tree, percent(20, x)),
+            (self.banner, percent(10, y)),
+            (self.chat_scroll[self.current_screen], percent(75, y)),
+            (self.input_box, percent(10, y)),
+            (self.help_banner, percent(20, y)),
+            (self.help_hint, percent(10, y)),
         )
-
-        await self.view.dock(
-            self.input_box,
-            size=percent(10, y),
-            name="input_box",
-        )
-        self.refresh(layout=True)  # A little bit too cautious
+        for widget, size in sizes:
+            if widget.layout_size != size:
+                widget.layout_size = size
+
+    def toggle_help(self) -> None:
+        # widgets inside a ScrollView keep their own order whatever the z
+        # of the dock, so the widgets under the help are hidden, not covered
+        self.help_menu_loaded = not self.help_menu_loaded
+        for widget in (self.help_banner, self.help_hint, self.help_scroll):
+            widget.visible = self.help_menu_loaded
+        for widget in (
+            self.member_list, self.right_separator, self.house_tree, self.left_separator,
+            self.banner, self.chat_scroll[self.current_screen], self.input_box,
+        ):
+            widget.visible = not self.help_menu_loaded
 
     async def action_reset_focus(self):
         await self.headbar.focus()
@@ -446,14 +577,42 @@ class ChatBox(App):
         Method to continously listen for new messages from the server
         """
 
-        # Is being called every 0.1 seconds to update
-        # Proposal for a `call_threaded` function has not been merged yet..
-        # see: https://github.com/Textualize/textual/issues/85
-
-        # recv message from queue
+        # whatever queued up while a frame was drawn goes into the next one
+        loop = asyncio.get_event_loop()
         while True:
-            msg = await self.cli.arecv()
-            await self.on_flush_message(msg)
+            msgs = [await self.cli.arecv()]
+            started = loop.time()
+            while len(msgs) < self.max_batch:
+                msg = self.cli.recv()
+                if msg is None:
+                    break
+                msgs.append(msg)
+            self.cache.append([msg for msg in msgs if not msg.action])
+            await self.on_flush_messages(msgs)
+            await asyncio.sleep(max(1 / self.max_fps - (loop.time() - started), 0))
+
+    async def on_flush_messages(self, messages: List[Message]):
+        """
+        Apply a batch of received messages with a single repaint and scroll
+        """
+        texts = []
+        for message in messages:
+            if message.action:
+                if texts:
+                    await self.perform_push_texts(texts)
+                    texts = []
+                await self.execute_message(message)
+            else:
+                texts.append(message)
+        if texts:
+            await self.perform_push_texts(texts)
+
+    async def perform_push_texts(self, messages: List[Message]) -> None:
+        screen = self.current_screen
+        for message in messages:
+            await self.chat_screen[screen].push_text(message, refresh=False)
+        self.chat_screen[screen].refresh(layout=True)
+        await self.chat_scroll[screen].key_end()
 
     async def on_flush_message(self, message: Message):
         if message.action:
@@ -485,9 +644,10 @@ def main():
     parser = argparse.ArgumentParser(description='chat log')
     parser.add_argument("-u", '--user_name', help="chat user name", type=str, default="User")
     parser.add_argument("-s", '--ws_url', help="ws url", type=str, default="ws://localhost:5555")
+    parser.add_argument('--max_fps', help="most screen updates per second", type=int, default=30)
     args = parser.parse_args()
     ws_url = f'{args.ws_url}/ws/{args.user_name}?token=default_tokne'
-    ChatBox.run(user=args.user_name, ws_url=ws_url)
+    ChatBox.run(user=args.user_name, ws_url=ws_url, max_fps=args.max_fps)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,104 @@
+import os
+import logging
+from typing import List, Optional, Tuple
+
+from message import Message
+
+READ_CHUNK = 64 * 1024
+
+
+class ChatCache(object):
+    """
+    Messages a client received, one json line each, appended as they
+    arrive. Pages are read backwards from the end, so opening a long
+    history costs one page no matter how large the file grew
+    """
+
+    def __init__(self, path: str, **kwargs):
+        self.path = path
+        # past this size the file is cut to its newer half when opened
+        self.max_bytes = kwargs.get('max_bytes', 32 * 1024 * 1024)
+        self.page_size = kwargs.get('page_size', 100)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.compact()
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.last_message_id = self._find_last_id()
+
+    def append(self, messages: List[Message]):
+        """
+        Write a batch of received messages with one write
+        """
+        if not messages:
+            return
+        self.file.write(''.join(msg.json() + '\n' for msg in messages))
+        self.file.flush()
+        for msg in messages:
+            if msg.message_id is not None and msg.message_id > (self.last_message_id or 0):
+                self.last_message_id = msg.message_id
+
+    def tail(self, count: Optional[int] = None) -> Tuple[List[Message], int]:
+        """
+        The newest `count` messages and the offset to page older ones from
+        """
+        return self.read_before(self.file.tell(), count)
+
+    def read_before(self, offset: int, count: Optional[int] = None) -> Tuple[List[Message], int]:
+        """
+        Up to `count` messages that end before `offset`, oldest first, and
+        the offset of the first one. An offset of 0 means nothing is older
+        """
+        count = count or self.page_size
+        data = b''
+        start = offset
+        with open(self.path, 'rb') as f:
+            # one newline more than lines wanted, the first piece may be cut
+            while start > 0 and data.count(b'\n') <= count:
+                chunk_start = max(start - READ_CHUNK, 0)
+                f.seek(chunk_start)
+                data = f.read(start - chunk_start) + data
+                start = chunk_start
+        lines = data.split(b'\n')
+        # whatever follows the last newline is a line still being written
+        offset -= len(lines.pop())
+        if start > 0:
+            lines = lines[1:]
+        lines = lines[-count:]
+        offset -= sum(len(line) + 1 for line in lines)
+        messages = []
+        for line in lines:
+            try:
+                messages.append(Message.from_json(line))
+            except ValueError:
+                # a line cut short by a crash
+                logging.debug(f'skipping unreadable line in {self.path}')
+        return messages, offset
+
+    def _find_last_id(self) -> Optional[int]:
+        offset = self.file.tell()
+        while offset > 0:
+            messages, offset = self.read_before(offset)
+            for msg in reversed(messages):
+                if msg.message_id is not None:
+                    return msg.message_id
+        return None
+
+    def compact(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) <= self.max_bytes:
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(-(self.max_bytes // 2), os.SEEK_END)
+            data = f.read()
+        # start at a line boundary
+        data = data[data.find(b'\n') + 1:]
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+
+    def close(self):
+        self.file.close()
+
+
+def default_path(user: str) -> str:
+    directory = os.environ.get('CHAT_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'chatbox'))
+    return os.path.join(directory, f'{user}.jsonl')
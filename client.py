@@ -1,110 +1,544 @@
 import logging
-import socket
+import random
 import asyncio
 import websockets
 import threading
+import zlib
+import concurrent.futures
+from urllib.parse import urlparse, urlencode, parse_qsl, urlunparse
 
 from message import Message
+import actions
+import codec
+
+# what a full queue does with one more message
+BLOCK = "block"
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+COALESCE = "coalesce"
+QUEUE_POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, COALESCE)
+
+
+class MessageQueue(asyncio.Queue):
+    """
+    An asyncio.Queue that, once `maxsize` is reached, waits, drops the oldest
+    message, refuses the new one or coalesces, as its policy says. `offer`
+    tells whether the new message was queued
+    """
+
+    def __init__(self, maxsize=0, policy=BLOCK, coalesce=None):
+        super().__init__(maxsize)
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f'unknown queue policy: {policy}')
+        self.policy = policy
+        # coalesce(queued, msg) -> the messages to keep queued, or None to refuse msg
+        self.coalesce = coalesce
+        # queued messages thrown away, new ones refused, and how many fewer
+        # messages coalescing left queued
+        self.dropped = 0
+        self.rejected = 0
+        self.coalesced = 0
+
+    async def offer(self, msg):
+        if self.policy == BLOCK:
+            await self.put(msg)
+            return True
+        return self.offer_nowait(msg)
+
+    def offer_nowait(self, msg):
+        if not self.full():
+            self.put_nowait(msg)
+            return True
+
+        if self.policy == DROP_OLDEST:
+            self.get_nowait()
+            self.dropped += 1
+            self.put_nowait(msg)
+            return True
+
+        if self.policy == COALESCE and self.coalesce:
+            queued = [self.get_nowait() for _ in range(self.qsize())]
+            kept = self.coalesce(queued, msg)
+            if kept is not None:
+                self.coalesced += len(queued) + 1 - len(kept)
+                for item in kept[-self.maxsize:]:
+                    self.put_nowait(item)
+                return True
+            for item in queued:
+                self.put_nowait(item)
+
+        self.rejected += 1
+        return False
+
+    def stats(self):
+        return {
+            "depth": self.qsize(),
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+            "coalesced": self.coalesced,
+        }
+
+
+def coalesce_sends(queued, msg):
+    """
+    Append the text to the last queued message if it goes the same way
+    """
+    last = queued[-1] if queued else None
+    if last is None or last.action or msg.action or \
+            (last.sender, last.room, last.reciepents, last.reciepent_ids) != \
+            (msg.sender, msg.room, msg.reciepents, msg.reciepent_ids):
+        return None
+    return queued[:-1] + [last.copy(update={"text": last.text + "\n" + msg.text})]
+
+
+SKIPPED_NOTICE = ' messages skipped, receiving too slowly'
+
+
+def skipped_count(msg):
+    """
+    How many messages `msg` stands for, the number in a skipped notice or 1
+    """
+    if msg.sender == "System" and msg.message_id is None and msg.text.endswith(SKIPPED_NOTICE):
+        count = msg.text[:-len(SKIPPED_NOTICE)]
+        if count.isdigit():
+            return int(count)
+    return 1
+
+
+def coalesce_received(queued, msg):
+    """
+    Collapse the backlog into one notice, like the server does for a slow socket.
+    Notices already queued, ours or the server's, add up their counts
+    """
+    notice = Message(
+        text=f'{sum(skipped_count(item) for item in queued)}{SKIPPED_NOTICE}',
+        created_at=msg.created_at,
+    )
+    return [notice, msg]
+
 
 class WsClient(object):
     def __init__(self, user_name, url, **kwargs):
         self.user_name = user_name
         self.url = url
-        self.read_timeout = kwargs.get('read_timeout', 1)
         self.write_timeout = kwargs.get('write_timeout', 1)
-        self.ping_timeout = kwargs.get('ping_timeout', 1)
-        self.sleep_time = kwargs.get('sleep_time', 5)
+        # seconds between pings on an open connection, each answered within ping_timeout
+        self.heartbeat_interval = kwargs.get('heartbeat_interval', 20)
+        self.ping_timeout = kwargs.get('ping_timeout', 10)
+        self.max_missed_pings = kwargs.get('max_missed_pings', 2)
+        # reconnect delays double from backoff_base up to backoff_cap seconds
+        self.backoff_base = kwargs.get('backoff_base', 0.5)
+        self.backoff_cap = kwargs.get('backoff_cap', 30)
         self.connected = False
+        # the server replays what was missed after this id on (re)connect
+        self.last_message_id = kwargs.get('last_message_id')
+        # wire formats offered to the server, preferred first
+        self.subprotocols = kwargs.get('subprotocols', list(codec.CODECS))
+        self.codec = codec.JSON
+        # with a batching codec, messages queued up to max_batch go out in one frame,
+        # batch_window seconds are waited for more to queue up
+        self.max_batch = kwargs.get('max_batch', 64)
+        self.batch_window = kwargs.get('batch_window', 0)
         self.loop = kwargs.get('loop') or asyncio.get_event_loop()
-        self.que_send = asyncio.Queue(loop=self.loop)
-        self.que_recv = asyncio.Queue(loop=self.loop)
+        # bounds for the queues between the caller and the socket, 0 is unbounded,
+        # see QUEUE_POLICIES for what happens once one is full
+        self.que_send = MessageQueue(kwargs.get('max_send_queue', 1024),
+                                     kwargs.get('send_policy', BLOCK), coalesce_sends)
+        self.que_recv = MessageQueue(kwargs.get('max_recv_queue', 1024),
+                                     kwargs.get('recv_policy', BLOCK), coalesce_received)
+        self.connects = 0
+        self.sent = 0
+        self.received = 0
+        # seconds the last ping took to be answered
+        self.ping_rtt = None
+        # called on the client's loop with every received message instead of
+        # queueing it for recv, hand slow work off to another thread
+        self.on_message = kwargs.get('on_message')
+        # deliver connection_enable once the server resumed and connection_disable
+        # after every connection that failed or dropped, for a ui showing the state
+        self.connection_actions = kwargs.get('connection_actions', False)
+        self.task = None
 
     def start(self):
+        """
+        Run the client, on a thread of its own if its loop is not the
+        current one. `send`, `recv` and `stop` may then be called from any thread
+        """
+        def _run():
+            asyncio.set_event_loop(self.loop)
+            self.task = self.loop.create_task(self.repl())
+            try:
+                self.loop.run_until_complete(self.task)
+            except asyncio.CancelledError:
+                pass
+
         if asyncio.get_event_loop() == self.loop:
-            self.loop.run_until_complete(self.repl())
+            _run()
             return
 
-        def _run():
-            self.loop.run_until_complete(self.repl())
-            
-        p = threading.Thread(target=_run).start()
-        return p
+        thread = threading.Thread(target=_run, name=f'ws-{self.user_name}', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        if self.task:
+            self.loop.call_soon_threadsafe(self.task.cancel)
 
     async def send_handler(self, ws):
         while True:
-            msg = await self.que_send.get()
+            msgs = [await self.que_send.get()]
+            if self.codec.batch:
+                if self.batch_window:
+                    await asyncio.sleep(self.batch_window)
+                while len(msgs) < self.max_batch and not self.que_send.empty():
+                    msgs.append(self.que_send.get_nowait())
+            if len(msgs) == 1:
+                data = self.codec.encode(msgs[0])
+            else:
+                data = self.codec.encode_batch([self.codec.encode(msg) for msg in msgs])
             try:
-                await asyncio.wait_for(ws.send(msg.json()), timeout=self.write_timeout, loop=self.loop)
-            except (asyncio.TimeoutError, websockets.exceptions.ConnectionClosed):
-                try:
-                    pong = await ws.ping()
-                    await asyncio.wait_for(pong, timeout=self.ping_timeout, loop=self.loop)
-                    logging.debug('Ping OK, keeping connection alive...')
-                    continue
-                except:
-                    logging.debug(
-                    'Ping error - retrying connection in {} sec (Ctrl-C to quit)'.format(self.sleep_time))
-                    self.connected = False
-                    await asyncio.sleep(self.sleep_time, loop=self.loop)
-                    break
-            
+                await asyncio.wait_for(ws.send(data), timeout=self.write_timeout)
+                self.sent += len(msgs)
+            except asyncio.TimeoutError:
+                logging.debug(f'send timed out after {self.write_timeout}s, reconnecting')
+                break
+            except websockets.exceptions.ConnectionClosed:
+                break
+
     async def recv_handler(self, ws):
+        # the socket is only read, staying alive is up to the heartbeat
+        try:
+            async for data in ws:
+                for msg in self.decode(data):
+                    logging.debug('> {}'.format(msg))
+                    self.received += 1
+                    if msg.action in actions.CONNECTION_ACTIONS and not self.connection_actions:
+                        continue
+                    await self.deliver(msg)
+                    # a message lost to a reconnect while it waited for room is replayed
+                    if msg.message_id is not None and msg.message_id > (self.last_message_id or 0):
+                        self.last_message_id = msg.message_id
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def deliver(self, msg):
+        if self.on_message:
+            self.on_message(msg)
+        else:
+            await self.que_recv.offer(msg)
+
+    async def on_connect(self, ws):
+        """
+        Called once a connection is up, before anything queued is sent
+        """
+
+    async def heartbeat(self, ws):
+        """
+        Ping every `heartbeat_interval` seconds, give up on the connection
+        after `max_missed_pings` pings in a row went unanswered
+        """
+        missed = 0
         while True:
+            await asyncio.sleep(self.heartbeat_interval)
             try:
-                data = await asyncio.wait_for(ws.recv(), timeout=self.read_timeout, loop=self.loop)
-                msg = Message.from_json(data)
-                logging.debug('> {}'.format(msg))
-                await self.que_recv.put(msg)
-            except (asyncio.TimeoutError, websockets.exceptions.ConnectionClosed):
-                try:
-                    pong = await ws.ping()
-                    await asyncio.wait_for(pong, timeout=self.ping_timeout, loop=self.loop)
-                    logging.debug('Ping OK, keeping connection alive...')
-                    continue
-                except:
-                    logging.debug(
-                    'Ping error - retrying connection in {} sec (Ctrl-C to quit)'.format(self.sleep_time))
-                    self.connected = False
-                    await asyncio.sleep(self.sleep_time, loop=self.loop)
-                    break
+                await self.ping(ws)
+                missed = 0
+            except asyncio.TimeoutError:
+                missed += 1
+                logging.debug(f'ping {missed} of {self.max_missed_pings} unanswered')
+                if missed >= self.max_missed_pings:
+                    await ws.close()
+                    return
+            except websockets.exceptions.ConnectionClosed:
+                return
+
+    def backoff(self, attempt):
+        """
+        Seconds to wait before reconnect `attempt`, exponential with full
+        jitter so clients dropped together do not come back together
+        """
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
 
     async def repl(self):
+        attempt = 0
         while True:
             try:
-                async with websockets.connect(self.url) as ws:
+                async with websockets.connect(self.resume_url(), subprotocols=self.subprotocols,
+                                              ping_interval=None) as ws:
+                    self.codec = codec.for_subprotocol(ws.subprotocol)
                     self.connected = True
-                    send_task = asyncio.ensure_future(self.send_handler(ws), loop=self.loop)
-                    recv_task = asyncio.ensure_future(self.recv_handler(ws), loop=self.loop)
-
-                    done, pending = await asyncio.wait([send_task, recv_task],
-                            loop=self.loop, return_when=asyncio.FIRST_COMPLETED)
-                    for task in pending:
-                        task.cancel()
-            
-            except socket.gaierror as err:
-                logger.debug(
-                        'Socket error - retrying connection in {} sec (Ctrl-C to quit)'.format(self.sleep_time))
-                await asyncio.sleep(self.sleep_time, loop=self.loop)
-                continue
+                    self.connects += 1
+                    attempt = 0
+                    await self.on_connect(ws)
+                    tasks = [
+                        asyncio.ensure_future(self.send_handler(ws), loop=self.loop),
+                        asyncio.ensure_future(self.recv_handler(ws), loop=self.loop),
+                        asyncio.ensure_future(self.heartbeat(ws), loop=self.loop),
+                    ]
+                    try:
+                        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                    finally:
+                        for task in tasks:
+                            task.cancel()
+            except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as err:
+                logging.debug(f'connection failed: {err}')
             except Exception as err:
                 logging.error(err)
                 break
+            finally:
+                self.connected = False
+
+            if self.connection_actions:
+                await self.deliver(Message(action=actions.CONNECTION_DISABLE))
+            delay = self.backoff(attempt)
+            attempt += 1
+            logging.debug(f'reconnecting in {delay:.2f}s (Ctrl-C to quit)')
+            await asyncio.sleep(delay)
+
+    async def ping(self, ws):
+        started = self.loop.time()
+        pong = await ws.ping()
+        await asyncio.wait_for(pong, timeout=self.ping_timeout)
+        self.ping_rtt = self.loop.time() - started
+
+    @property
+    def reconnects(self):
+        return max(self.connects - 1, 0)
+
+    def stats(self):
+        return {
+            "connected": self.connected,
+            "send_queue": self.que_send.stats(),
+            "recv_queue": self.que_recv.stats(),
+            "sent": self.sent,
+            "received": self.received,
+            "reconnects": self.reconnects,
+            "ping_rtt": self.ping_rtt,
+        }
+
+    def decode(self, data):
+        """
+        The messages of a frame, more than one if it is a batch
+        """
+        if isinstance(data, bytes):
+            return codec.BINARY.decode_frames(data)
+        return codec.JSON.decode_frames(data)
+
+    def resume_url(self):
+        if self.last_message_id is None:
+            return self.url
+        parts = urlparse(self.url)
+        query = dict(parse_qsl(parts.query))
+        query['last_id'] = str(self.last_message_id)
+        return urlunparse(parts._replace(query=urlencode(query)))
 
     async def asend(self, msg):
-        return await self.que_send.put(msg)
+        """
+        Queue a message for sending, False if the send queue refused it
+        """
+        return await self.que_send.offer(msg)
 
     async def arecv(self):
         return await self.que_recv.get()
 
-    def send(self, msg):
-        return self.que_send.put_nowait(msg)
+    def send(self, msg, timeout=None):
+        """
+        Queue a message from any thread, False if it was refused. On the
+        client's own loop it never waits, a full queue with the block policy
+        refuses too. From other threads it waits up to `timeout` seconds for
+        room in the queue
+        """
+        if not self.loop.is_running() or self._in_loop():
+            return self.que_send.offer_nowait(msg)
 
-    def recv(self):
+        future = asyncio.run_coroutine_threadsafe(self.asend(msg), self.loop)
         try:
-            msg = self.que_recv.get_nowait()
-            return msg
-        except:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            self.que_send.rejected += 1
+            return False
+
+    def recv(self, timeout=0):
+        """
+        The next received message, or None if none came within `timeout`
+        seconds. 0 polls, None waits as long as it takes. Waiting wakes up as
+        soon as a message arrives, and only works off the client's own loop
+        """
+        if not self.loop.is_running() or self._in_loop():
+            if timeout != 0:
+                raise RuntimeError('recv only waits while the client runs on another thread, use arecv')
+            try:
+                return self.que_recv.get_nowait()
+            except asyncio.QueueEmpty:
+                return None
+
+        future = asyncio.run_coroutine_threadsafe(self._recv(timeout), self.loop)
+        return future.result()
+
+    async def _recv(self, timeout):
+        if timeout == 0:
+            try:
+                return self.que_recv.get_nowait()
+            except asyncio.QueueEmpty:
+                return None
+        try:
+            return await asyncio.wait_for(self.que_recv.get(), timeout)
+        except asyncio.TimeoutError:
             return None
+
+    def _in_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+
+class MuxSession(object):
+    """
+    One user of a `MuxClient`, with the sending and receiving side of a
+    `WsClient`. Messages delivered to several sessions are the same object
+    """
+
+    def __init__(self, client, user_name, **kwargs):
+        self.client = client
+        self.user_name = user_name
+        self.rooms = set()
+        self.que_recv = MessageQueue(kwargs.get('max_recv_queue', 1024),
+                                     kwargs.get('recv_policy', BLOCK), coalesce_received)
+        self.on_message = kwargs.get('on_message')
+
+    @property
+    def loop(self):
+        return self.client.loop
+
+    async def deliver(self, msg):
+        if self.on_message:
+            self.on_message(msg)
+        else:
+            await self.que_recv.offer(msg)
+
+    def wants(self, msg):
+        """
+        Whether the server meant the message for this user, see `ConnectionManager.visible`
+        """
+        if msg.reciepent_ids or msg.reciepents:
+            return self.user_name in (msg.reciepent_ids or []) + (msg.reciepents or [])
+        if msg.room:
+            return msg.room in self.rooms
+        return True
+
+    def tag(self, msg):
+        """
+        A copy of `msg` naming this session, the caller may send the same
+        message through other sessions while this one is still queued
+        """
+        return msg.copy(update={"sender_id": self.user_name})
+
+    async def asend(self, msg):
+        return await self.client.asend(self.tag(msg))
+
+    def send(self, msg, timeout=None):
+        return self.client.send(self.tag(msg), timeout)
+
+    def join(self, room, timeout=None):
+        self.rooms.add(room)
+        return self.send(Message(action=actions.JOIN, room=room), timeout)
+
+    def leave(self, room, timeout=None):
+        self.rooms.discard(room)
+        return self.send(Message(action=actions.LEAVE, room=room), timeout)
+
+    arecv = WsClient.arecv
+    recv = WsClient.recv
+    _recv = WsClient._recv
+    _in_loop = WsClient._in_loop
+
+
+class MuxClient(WsClient):
+    """
+    Many users over one connection to the server's /mux endpoint, each a
+    `MuxSession`. The connection pings, reconnects and resumes once for all
+    of them
+
+        client = MuxClient("farm", "ws://localhost:5555/mux/farm")
+        alice = client.session("alice")
+    """
+
+    def __init__(self, name, url, **kwargs):
+        super().__init__(name, url, **kwargs)
+        self.sessions = {}
+
+    def session(self, user_name, **kwargs):
+        """
+        The session of a user, attached on first use. Takes the queue
+        options and on_message of `WsClient`
+        """
+        session = self.sessions.get(user_name)
+        if session is None:
+            session = self.sessions[user_name] = MuxSession(self, user_name, **kwargs)
+            # sessions added while offline go in the url of the next connect
+            self.send(Message(action=actions.ATTACH, sender_id=user_name))
+        return session
+
+    def close_session(self, user_name):
+        if self.sessions.pop(user_name, None):
+            self.send(Message(action=actions.DETACH, sender_id=user_name))
+
+    def resume_url(self):
+        parts = urlparse(super().resume_url())
+        query = dict(parse_qsl(parts.query))
+        query['sessions'] = ','.join(self.sessions)
+        return urlunparse(parts._replace(query=urlencode(query)))
+
+    async def on_connect(self, ws):
+        # rooms are joined per connection, join them again
+        for session in list(self.sessions.values()):
+            for room in session.rooms:
+                await ws.send(self.codec.encode(session.tag(Message(action=actions.JOIN, room=room))))
+
+    async def deliver(self, msg):
+        for session in list(self.sessions.values()):
+            if session.wants(msg):
+                await session.deliver(msg)
+
+    def stats(self):
+        stats = super().stats()
+        stats["sessions"] = len(self.sessions)
+        return stats
+
+
+class MuxPool(object):
+    """
+    Users spread over `size` multiplexed connections by a hash of their name.
+    Connection i of a pool at ws://host/mux/farm is ws://host/mux/farm-i
+    """
+
+    def __init__(self, url, size=4, **kwargs):
+        parts = urlparse(url)
+        self.user_name = parts.path.rsplit("/", 1)[-1]
+        self.loop = kwargs.get('loop') or asyncio.get_event_loop()
+        kwargs['loop'] = self.loop
+        self.clients = []
+        for i in range(size):
+            name = f'{self.user_name}-{i}'
+            client_url = urlunparse(parts._replace(path=f'{parts.path}-{i}'))
+            self.clients.append(MuxClient(name, client_url, **kwargs))
+        self.task = None
+
+    def session(self, user_name, **kwargs):
+        client = self.clients[zlib.crc32(user_name.encode()) % len(self.clients)]
+        return client.session(user_name, **kwargs)
+
+    async def repl(self):
+        await asyncio.gather(*[client.repl() for client in self.clients])
+
+    start = WsClient.start
+    stop = WsClient.stop
+
+    def stats(self):
+        return [client.stats() for client in self.clients]
+
 if __name__ == '__main__':
     import aioconsole
     user_name = "bob"
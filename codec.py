@@ -0,0 +1,260 @@
+import json
+import struct
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from message import Message
+
+Frame = Union[str, bytes]
+
+JSON_PROTOCOL = "chat.json"
+BINARY_PROTOCOL = "chat.bin.v1"
+# same formats, but a frame may carry a batch of messages
+JSON_BATCH_PROTOCOL = "chat.json.batch"
+BINARY_BATCH_PROTOCOL = "chat.bin.v1.batch"
+
+# version, flags, created_at, message_id, then the byte lengths of
+# sender, text and action, which follow as utf-8
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("!BBqQIII")
+STR_LEN = struct.Struct("!I")
+LIST_LEN = struct.Struct("!H")
+# a binary batch is this marker and a count, then every message frame
+# prefixed with its length
+BINARY_BATCH_MARKER = 0x80 | BINARY_VERSION
+BINARY_BATCH_HEADER = struct.Struct("!BI")
+
+# flags for the optional fields, present ones follow in this order:
+# sender_id and room as length prefixed strings, the recipient lists as
+# a count and that many length prefixed strings
+HAS_MESSAGE_ID = 1
+HAS_SENDER_ID = 2
+HAS_ROOM = 4
+HAS_RECIEPENTS = 8
+HAS_RECIEPENT_IDS = 16
+
+
+class JsonCodec(object):
+    """
+    Text frames of `Message.json()`, what the browser page speaks. A batch
+    is a json array of messages
+    """
+
+    # encodings of a message are shared between codecs of the same key
+    key = "json"
+    binary = False
+
+    def __init__(self, batch: bool = False):
+        self.batch = batch
+        self.subprotocol = JSON_BATCH_PROTOCOL if batch else JSON_PROTOCOL
+
+    def encode(self, message: Message) -> Frame:
+        return message.json()
+
+    def encode_batch(self, frames: List[Frame]) -> Frame:
+        return '[' + ','.join(frames) + ']'
+
+    def decode(self, data: Frame, validate: bool = False) -> Message:
+        return Message.from_json(data, validate=validate)
+
+    def decode_frames(self, data: Frame, validate: bool = False) -> List[Message]:
+        """
+        The messages of a single or a batched frame
+        """
+        decoded = json.loads(data)
+        parse = Message.validate if validate else Message.from_dict
+        if isinstance(decoded, list):
+            return [parse(msg_dict) for msg_dict in decoded]
+        return [parse(decoded)]
+
+
+class BinaryCodec(object):
+    """
+    Binary frames of a fixed header and utf-8 strings. Parsing yields
+    correctly typed fields by construction, so no validation pass is needed
+    """
+
+    key = "binary"
+    binary = True
+
+    def __init__(self, batch: bool = False):
+        self.batch = batch
+        self.subprotocol = BINARY_BATCH_PROTOCOL if batch else BINARY_PROTOCOL
+
+    def encode(self, message: Message) -> Frame:
+        sender = message.sender.encode()
+        text = message.text.encode()
+        action = message.action.encode()
+        flags = 0
+        tail = []
+        if message.message_id is not None:
+            flags |= HAS_MESSAGE_ID
+        if message.sender_id is not None:
+            flags |= HAS_SENDER_ID
+            _pack_str(tail, message.sender_id)
+        if message.room is not None:
+            flags |= HAS_ROOM
+            _pack_str(tail, message.room)
+        if message.reciepents is not None:
+            flags |= HAS_RECIEPENTS
+            _pack_list(tail, message.reciepents)
+        if message.reciepent_ids is not None:
+            flags |= HAS_RECIEPENT_IDS
+            _pack_list(tail, message.reciepent_ids)
+
+        header = BINARY_HEADER.pack(
+            BINARY_VERSION, flags, message.created_at, message.message_id or 0,
+            len(sender), len(text), len(action),
+        )
+        return b''.join([header, sender, text, action] + tail)
+
+    def encode_batch(self, frames: List[Frame]) -> Frame:
+        parts = [BINARY_BATCH_HEADER.pack(BINARY_BATCH_MARKER, len(frames))]
+        for frame in frames:
+            parts.append(STR_LEN.pack(len(frame)))
+            parts.append(frame)
+        return b''.join(parts)
+
+    def decode(self, data: Frame, validate: bool = False) -> Message:
+        if isinstance(data, str):
+            raise ValueError('binary codec got a text frame')
+        try:
+            return self._decode(data)
+        except struct.error as err:
+            raise ValueError(f'malformed binary frame: {err}')
+
+    def decode_frames(self, data: Frame, validate: bool = False) -> List[Message]:
+        """
+        The messages of a single or a batched frame
+        """
+        if isinstance(data, str):
+            raise ValueError('binary codec got a text frame')
+        if not data or data[0] != BINARY_BATCH_MARKER:
+            return [self.decode(data)]
+        try:
+            _, count = BINARY_BATCH_HEADER.unpack_from(data, 0)
+            offset = BINARY_BATCH_HEADER.size
+            messages = []
+            for _ in range(count):
+                (length,) = STR_LEN.unpack_from(data, offset)
+                offset += STR_LEN.size
+                messages.append(self._decode(data[offset:offset + length]))
+                offset += length
+            return messages
+        except struct.error as err:
+            raise ValueError(f'malformed binary batch: {err}')
+
+    def _decode(self, data: bytes) -> Message:
+        version, flags, created_at, message_id, n_sender, n_text, n_action = \
+            BINARY_HEADER.unpack_from(data, 0)
+        if version != BINARY_VERSION:
+            raise ValueError(f'unsupported binary frame version {version}')
+
+        offset = BINARY_HEADER.size
+        end = offset + n_sender + n_text + n_action
+        if end > len(data):
+            raise ValueError('truncated binary frame')
+        sender = data[offset:offset + n_sender].decode()
+        offset += n_sender
+        text = data[offset:offset + n_text].decode()
+        offset += n_text
+        action = data[offset:end].decode()
+        offset = end
+
+        sender_id = room = reciepents = reciepent_ids = None
+        if flags & HAS_SENDER_ID:
+            sender_id, offset = _unpack_str(data, offset)
+        if flags & HAS_ROOM:
+            room, offset = _unpack_str(data, offset)
+        if flags & HAS_RECIEPENTS:
+            reciepents, offset = _unpack_list(data, offset)
+        if flags & HAS_RECIEPENT_IDS:
+            reciepent_ids, offset = _unpack_list(data, offset)
+        if not flags & HAS_MESSAGE_ID:
+            message_id = None
+        return Message(sender, text, action, created_at, sender_id, message_id,
+                       reciepents, reciepent_ids, room)
+
+
+def _pack_str(parts: List[bytes], value: str):
+    data = value.encode()
+    parts.append(STR_LEN.pack(len(data)))
+    parts.append(data)
+
+
+def _pack_list(parts: List[bytes], values: List[str]):
+    parts.append(LIST_LEN.pack(len(values)))
+    for value in values:
+        _pack_str(parts, value)
+
+
+def _unpack_str(data: bytes, offset: int):
+    (length,) = STR_LEN.unpack_from(data, offset)
+    offset += STR_LEN.size
+    if offset + length > len(data):
+        raise ValueError('truncated binary frame')
+    return data[offset:offset + length].decode(), offset + length
+
+
+def _unpack_list(data: bytes, offset: int):
+    (count,) = LIST_LEN.unpack_from(data, offset)
+    offset += LIST_LEN.size
+    values = []
+    for _ in range(count):
+        value, offset = _unpack_str(data, offset)
+        values.append(value)
+    return values, offset
+
+
+Codec = Union[JsonCodec, BinaryCodec]
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+JSON_BATCH = JsonCodec(batch=True)
+BINARY_BATCH = BinaryCodec(batch=True)
+
+# preferred first
+CODECS: Dict[str, Codec] = {
+    BINARY_BATCH_PROTOCOL: BINARY_BATCH,
+    BINARY_PROTOCOL: BINARY,
+    JSON_BATCH_PROTOCOL: JSON_BATCH,
+    JSON_PROTOCOL: JSON,
+}
+
+
+def negotiate(offered: Sequence[str]) -> Tuple[Codec, Optional[str]]:
+    """
+    The codec for a handshake offering `offered` subprotocols, and the
+    subprotocol to accept with, None when the peer offered none of ours
+    """
+    for subprotocol, codec in CODECS.items():
+        if subprotocol in offered:
+            return codec, subprotocol
+    return JSON, None
+
+
+def for_subprotocol(subprotocol: Optional[str]) -> Codec:
+    return CODECS.get(subprotocol, JSON)
+
+
+if __name__ == '__main__':
+    import timeit
+
+    msg = Message(text="hello " * 8, sender="Bob", sender_id="bob", created_at=1658000000,
+                  message_id=123456, reciepent_ids=["alice", "carol"])
+    json_frame = JSON.encode(msg)
+    binary_frame = BINARY.encode(msg)
+    assert BINARY.decode(binary_frame) == msg
+    print(f'frame bytes: json {len(json_frame.encode())}, binary {len(binary_frame)}')
+    assert BINARY.decode_frames(BINARY.encode_batch([binary_frame] * 3)) == [msg] * 3
+    assert JSON.decode_frames(JSON.encode_batch([json_frame] * 3)) == [msg] * 3
+
+    def encode_fresh(codec):
+        # the json encoding is cached on the message, time a first encode
+        msg._json = None
+        return codec.encode(msg)
+
+    n = 20000
+    for name, codec, frame in (('json', JSON, json_frame), ('binary', BINARY, binary_frame)):
+        encode = timeit.timeit(lambda: encode_fresh(codec), number=n) / n * 1e6
+        decode = timeit.timeit(lambda: codec.decode(frame), number=n) / n * 1e6
+        print(f'{name:6} encode {encode:6.2f}us  decode {decode:6.2f}us')
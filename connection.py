@@ -0,0 +1,228 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from fastapi import WebSocket
+
+from message import Message
+import codec
+import metrics
+
+# what to do with a connection once its outbound queue hits the high water mark
+DROP_OLDEST = "drop_oldest"
+COALESCE = "coalesce"
+DISCONNECT = "disconnect"
+OVERFLOW_POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+# "Try Again Later", the client is free to reconnect and resume
+WS_1013_TRY_AGAIN_LATER = 1013
+
+
+def frame_size(data: codec.Frame) -> int:
+    """
+    Bytes a frame takes on the wire, json text is ascii unless it was built elsewhere
+    """
+    if isinstance(data, bytes) or data.isascii():
+        return len(data)
+    return len(data.encode())
+
+
+class Connection:
+    """
+    A websocket with a bounded outbound queue drained by its own writer task,
+    so a slow receiver only delays itself
+    """
+
+    def __init__(self, websocket: WebSocket, client_id: str = "", **kwargs):
+        self.websocket = websocket
+        self.client_id = client_id
+        # the wire format negotiated in the handshake
+        self.codec: codec.Codec = kwargs.get('codec', codec.JSON)
+        self.high_water = kwargs.get('high_water', 256)
+        # seconds a frame may wait in the queue before the client counts as slow
+        self.max_age = kwargs.get('max_age', 10)
+        # seconds a single send may hang before the socket counts as stuck
+        self.send_timeout = kwargs.get('send_timeout', 10)
+        # with a batching codec, frames queued up to these limits go out as one
+        self.max_batch = kwargs.get('max_batch', 64)
+        self.max_batch_bytes = kwargs.get('max_batch_bytes', 64 * 1024)
+        # seconds to wait for a batch to fill, 0 sends what queued up meanwhile
+        self.batch_window = kwargs.get('batch_window', 0)
+        self.policy = kwargs.get('policy', DROP_OLDEST)
+        if self.policy not in OVERFLOW_POLICIES:
+            raise ValueError(f'unknown overflow policy: {self.policy}')
+        self.on_evict: Optional[Callable[["Connection", str], None]] = kwargs.get('on_evict')
+        self.rooms: Set[str] = set()
+        # a multiplexed connection carries the sessions of many users, each
+        # message names its session in sender_id. client_ids are the users
+        # the connection receives for, session_rooms the rooms of each
+        self.mux = kwargs.get('mux', False)
+        self.client_ids: Set[str] = set() if self.mux else {client_id}
+        self.session_rooms: Dict[str, Set[str]] = {}
+
+        # enqueue time, message_id and the encoded frame
+        self.queue: Deque[Tuple[float, Optional[int], codec.Frame]] = deque()
+        self.wakeup = asyncio.Event()
+        self.writer_task: Optional[asyncio.Task] = None
+        self.sending_since = 0.0
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.evicted: Optional[str] = None
+        # frames up to this message_id went out while replaying history
+        self.replayed_id = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self.queue)
+
+    @property
+    def age(self) -> float:
+        """
+        Seconds the oldest undelivered frame has been waiting
+        """
+        if not self.queue:
+            return 0.0
+        return time.monotonic() - self.queue[0][0]
+
+    def stats(self) -> dict:
+        return {
+            "client_id": self.client_id,
+            "sessions": len(self.client_ids) if self.mux else None,
+            "depth": self.depth,
+            "age": round(self.age, 3),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+        }
+
+    def start(self):
+        self.writer_task = asyncio.ensure_future(self.writer())
+
+    def close(self):
+        if self.writer_task:
+            self.writer_task.cancel()
+            self.writer_task = None
+        self.queue.clear()
+
+    async def writer(self):
+        while True:
+            while not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            if self.codec.batch and self.batch_window and len(self.queue) < self.max_batch:
+                await asyncio.sleep(self.batch_window)
+            frames = self.take()
+            if not frames:
+                continue
+            data = frames[0] if len(frames) == 1 else self.codec.encode_batch(frames)
+            self.sending_since = time.monotonic()
+            try:
+                if isinstance(data, bytes):
+                    await self.websocket.send_bytes(data)
+                else:
+                    await self.websocket.send_text(data)
+            except Exception as err:
+                # the receive loop of the endpoint notices the disconnect
+                logging.debug(f'writer for {self.client_id} stopped: {err}')
+                return
+            self.sending_since = 0.0
+            self.sent += len(frames)
+            metrics.messages_out.mark(len(frames))
+            metrics.frames_out.mark()
+            metrics.bytes_out.mark(frame_size(data))
+
+    def take(self) -> List[codec.Frame]:
+        """
+        The next frame, or as many as fit a batch if the peer takes batches
+        """
+        frames = []
+        size = 0
+        limit = self.max_batch if self.codec.batch else 1
+        while self.queue and len(frames) < limit and size < self.max_batch_bytes:
+            _, message_id, data = self.queue.popleft()
+            if message_id is not None and message_id <= self.replayed_id:
+                continue
+            frames.append(data)
+            size += len(data)
+        return frames
+
+    def first_queued_id(self) -> Optional[int]:
+        for _, message_id, _ in self.queue:
+            if message_id is not None:
+                return message_id
+        return None
+
+    def push_message(self, message: Message, frames: Dict[str, codec.Frame]) -> bool:
+        """
+        Queue a message, `frames` carries its encodings across the
+        connections it goes to so every codec encodes it once
+        """
+        data = frames.get(self.codec.key)
+        if data is None:
+            data = frames[self.codec.key] = self.codec.encode(message)
+        return self.push(data, message.message_id)
+
+    def push(self, data: codec.Frame, message_id: Optional[int] = None) -> bool:
+        """
+        Queue an already encoded frame, never waits on the socket
+        """
+        if self.evicted:
+            return False
+
+        now = time.monotonic()
+        if self.sending_since and now - self.sending_since > self.send_timeout:
+            # no policy helps a socket that stopped draining altogether
+            self.evict('send timed out')
+            return False
+
+        if len(self.queue) >= self.high_water or (self.queue and now - self.queue[0][0] > self.max_age):
+            if not self.overflow(now):
+                return False
+
+        self.queue.append((now, message_id, data))
+        self.wakeup.set()
+        return True
+
+    def overflow(self, now: float) -> bool:
+        if self.policy == DISCONNECT:
+            self.evict(f'outbound queue at {len(self.queue)} frames')
+            return False
+
+        if self.policy == COALESCE:
+            # collapse the whole backlog into a single notice
+            skipped = len(self.queue)
+            self.queue.clear()
+            self.coalesced += skipped
+            notice = Message(
+                text=f'{skipped} messages skipped, receiving too slowly',
+                created_at=int(time.time()),
+            )
+            self.queue.append((now, None, self.codec.encode(notice)))
+            return True
+
+        while self.queue and (len(self.queue) >= self.high_water or now - self.queue[0][0] > self.max_age):
+            self.queue.popleft()
+            self.dropped += 1
+        return True
+
+    def evict(self, reason: str):
+        if self.evicted:
+            return
+        self.evicted = reason
+        logging.warning(f'evicting slow consumer {self.client_id}: {reason}')
+        self.close()
+        asyncio.ensure_future(self._close_socket(reason))
+        if self.on_evict:
+            self.on_evict(self, reason)
+
+    async def _close_socket(self, reason: str):
+        try:
+            await asyncio.wait_for(
+                self.websocket.close(code=WS_1013_TRY_AGAIN_LATER),
+                timeout=self.send_timeout,
+            )
+        except Exception as err:
+            logging.debug(f'closing {self.client_id} failed: {err}')
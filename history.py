@@ -0,0 +1,379 @@
+import os
+import mmap
+import struct
+import asyncio
+import logging
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from message import Message
+
+# payload length, message_id, created_at, then the json encoded message
+RECORD_HEADER = struct.Struct("!IQq")
+# sealed segments keep their sparse index next to them:
+# a header of (size, last_id, last_time) and entries of (message_id, created_at, offset)
+INDEX_HEADER = struct.Struct("!QQq")
+INDEX_ENTRY = struct.Struct("!Qqq")
+
+SEGMENT_SUFFIX = ".log"
+INDEX_SUFFIX = ".idx"
+
+# message_id, created_at, encoded message
+Record = Tuple[int, int, bytes]
+
+
+class Segment(object):
+    """
+    One file of the log, named after the first message_id it holds
+    """
+
+    def __init__(self, directory: str, base_id: int):
+        self.base_id = base_id
+        self.path = os.path.join(directory, f'{base_id:020d}{SEGMENT_SUFFIX}')
+        self.index_path = os.path.join(directory, f'{base_id:020d}{INDEX_SUFFIX}')
+        # bytes of complete records, anything after is an unfinished write
+        self.size = 0
+        self.count = 0
+        self.last_id = base_id - 1
+        self.last_time = 0
+        # sparse index, one entry every `index_interval` records
+        self.index_ids: List[int] = []
+        self.index_times: List[int] = []
+        self.index_offsets: List[int] = []
+        self._map: Optional[mmap.mmap] = None
+
+    def add_record(self, message_id: int, created_at: int, offset: int, index_interval: int):
+        if self.count % index_interval == 0:
+            self.index_ids.append(message_id)
+            self.index_times.append(created_at)
+            self.index_offsets.append(offset)
+        self.count += 1
+        self.last_id = message_id
+        self.last_time = created_at
+
+    def view(self) -> Optional[mmap.mmap]:
+        if not self.size:
+            return None
+        if self._map is None or len(self._map) < self.size:
+            # the active segment grew since it was mapped
+            self.close()
+            with open(self.path, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def scan(self, offset: int, index_interval: int):
+        """
+        Read record headers from `offset` on, extending the index
+        """
+        file_size = os.path.getsize(self.path)
+        if file_size <= offset:
+            return
+        with open(self.path, 'rb') as f:
+            view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            while offset + RECORD_HEADER.size <= file_size:
+                length, message_id, created_at = RECORD_HEADER.unpack_from(view, offset)
+                end = offset + RECORD_HEADER.size + length
+                if end > file_size:
+                    break
+                self.add_record(message_id, created_at, offset, index_interval)
+                offset = end
+        finally:
+            view.close()
+        self.size = offset
+
+    def records(self, offset: int) -> Iterator[Record]:
+        view = self.view()
+        while view is not None and offset < self.size:
+            length, message_id, created_at = RECORD_HEADER.unpack_from(view, offset)
+            start = offset + RECORD_HEADER.size
+            offset = start + length
+            yield message_id, created_at, view[start:offset]
+
+    def save_index(self):
+        with open(self.index_path, 'wb') as f:
+            f.write(INDEX_HEADER.pack(self.size, self.last_id, self.last_time))
+            for entry in zip(self.index_ids, self.index_times, self.index_offsets):
+                f.write(INDEX_ENTRY.pack(*entry))
+
+    def load_index(self) -> bool:
+        if not os.path.exists(self.index_path):
+            return False
+        with open(self.index_path, 'rb') as f:
+            data = f.read()
+        self.size, self.last_id, self.last_time = INDEX_HEADER.unpack_from(data, 0)
+        for offset in range(INDEX_HEADER.size, len(data), INDEX_ENTRY.size):
+            message_id, created_at, record_offset = INDEX_ENTRY.unpack_from(data, offset)
+            self.index_ids.append(message_id)
+            self.index_times.append(created_at)
+            self.index_offsets.append(record_offset)
+        return True
+
+
+class MessageLog(object):
+    """
+    Append-only message history split into segment files. Appends are
+    buffered and written plus fsynced every `flush_interval` seconds on a
+    worker thread, reads go through memory-mapped segments and a sparse
+    index, so neither scans nor waits on the disk
+    """
+
+    def __init__(self, directory: str, **kwargs):
+        self.directory = directory
+        self.segment_bytes = kwargs.get('segment_bytes', 64 * 1024 * 1024)
+        self.index_interval = kwargs.get('index_interval', 64)
+        self.flush_interval = kwargs.get('flush_interval', 0.1)
+        self.segments: List[Segment] = []
+        self.base_ids: List[int] = []
+        self.active_file: Optional[BinaryIO] = None
+        # records not on disk yet, `writing` is the batch being flushed
+        self.pending: List[Record] = []
+        self.writing: List[Record] = []
+        # guards the segment metadata the flush thread updates
+        self.lock = threading.Lock()
+        self.flush_task: Optional[asyncio.Task] = None
+        os.makedirs(directory, exist_ok=True)
+        self.refresh()
+
+    @property
+    def last_id(self) -> int:
+        if self.pending:
+            return self.pending[-1][0]
+        if self.writing:
+            return self.writing[-1][0]
+        return self.segments[-1].last_id if self.segments else 0
+
+    async def start(self):
+        self.flush_task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as err:
+                logging.exception(err)
+
+    async def close(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+        if self.active_file:
+            self.active_file.close()
+            self.active_file = None
+        for segment in self.segments:
+            segment.close()
+
+    def refresh(self):
+        """
+        Pick up segments and records appended by another process
+        """
+        names = sorted(n for n in os.listdir(self.directory) if n.endswith(SEGMENT_SUFFIX))
+        with self.lock:
+            if self.segments and self.active_file is None:
+                # the newest segment known so far may have grown
+                last = self.segments[-1]
+                last.scan(last.size, self.index_interval)
+            known = set(self.base_ids)
+            for name in names:
+                base_id = int(name[:-len(SEGMENT_SUFFIX)])
+                if base_id in known:
+                    continue
+                segment = Segment(self.directory, base_id)
+                if not segment.load_index():
+                    segment.scan(0, self.index_interval)
+                self.segments.append(segment)
+                self.base_ids.append(base_id)
+
+    def append(self, message: Message):
+        """
+        Buffer a message, its message_id has to be larger than any before
+        """
+        self.pending.append((message.message_id, message.created_at, message.json().encode()))
+
+    async def flush(self):
+        if not self.pending or self.writing:
+            return
+        self.writing, self.pending = self.pending, []
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, self._write, self.writing)
+        finally:
+            self.writing = []
+
+    def _write(self, batch: List[Record]):
+        # runs on a worker thread, only metadata updates take the lock
+        chunk = []
+        size = self.segments[-1].size if self.active_file else 0
+        for message_id, created_at, payload in batch:
+            if self.active_file is None or size >= self.segment_bytes:
+                self._write_chunk(chunk)
+                chunk = []
+                self._roll(message_id)
+                size = self.segments[-1].size
+            chunk.append((message_id, created_at, payload))
+            size += RECORD_HEADER.size + len(payload)
+        self._write_chunk(chunk)
+
+    def _write_chunk(self, chunk: List[Record]):
+        if not chunk:
+            return
+        segment = self.segments[-1]
+        data = b''.join(RECORD_HEADER.pack(len(p), i, t) + p for i, t, p in chunk)
+        self.active_file.write(data)
+        self.active_file.flush()
+        os.fsync(self.active_file.fileno())
+
+        with self.lock:
+            offset = segment.size
+            for message_id, created_at, payload in chunk:
+                segment.add_record(message_id, created_at, offset, self.index_interval)
+                offset += RECORD_HEADER.size + len(payload)
+            segment.size = offset
+
+    def _roll(self, base_id: int):
+        if self.active_file is None and self.segments and self.segments[-1].size < self.segment_bytes:
+            # taking over as the writer, continue the newest segment after
+            # cutting off a record its previous writer left unfinished
+            self.refresh()
+            segment = self.segments[-1]
+            self.active_file = open(segment.path, 'r+b')
+            self.active_file.truncate(segment.size)
+            self.active_file.seek(segment.size)
+            return
+
+        if self.active_file is not None:
+            self.active_file.close()
+            self.segments[-1].save_index()
+        segment = Segment(self.directory, base_id)
+        self.active_file = open(segment.path, 'ab')
+        with self.lock:
+            self.segments.append(segment)
+            self.base_ids.append(base_id)
+
+    def read(self, after_id: int = 0, limit: int = 100) -> List[Message]:
+        """
+        Up to `limit` messages with a message_id above `after_id`
+        """
+        return self._decode(self.read_records(after_id, limit))
+
+    def read_records(self, after_id: int = 0, limit: int = 100) -> List[Record]:
+        records = []
+        with self.lock:
+            first = max(bisect_right(self.base_ids, after_id + 1) - 1, 0)
+            for segment in self.segments[first:]:
+                if segment.last_id <= after_id:
+                    continue
+                pos = max(bisect_right(segment.index_ids, after_id + 1) - 1, 0)
+                offset = segment.index_offsets[pos] if segment.index_offsets else 0
+                for record in segment.records(offset):
+                    if record[0] > after_id:
+                        records.append(record)
+                        if len(records) >= limit:
+                            break
+                if len(records) >= limit:
+                    break
+        records.extend(self._buffered(records, lambda r: r[0] > after_id))
+        return records[:limit]
+
+    def read_time(self, start: int, end: int, limit: int = 100) -> List[Message]:
+        """
+        Up to `limit` messages created between `start` and `end`, inclusive.
+        created_at comes from the server clock, so the log is ordered by it
+        """
+        records = []
+        done = False
+        with self.lock:
+            for segment in self.segments:
+                if done or (segment.index_times and segment.index_times[0] > end):
+                    break
+                if segment.last_time < start:
+                    continue
+                pos = max(bisect_left(segment.index_times, start) - 1, 0)
+                offset = segment.index_offsets[pos] if segment.index_offsets else 0
+                for record in segment.records(offset):
+                    if record[1] > end:
+                        done = True
+                        break
+                    if record[1] >= start:
+                        records.append(record)
+                        if len(records) >= limit:
+                            done = True
+                            break
+        records.extend(self._buffered(records, lambda r: start <= r[1] <= end))
+        return self._decode(records[:limit])
+
+    def _buffered(self, records: List[Record], match) -> List[Record]:
+        # a record may be both on disk and in `writing` while a flush finishes
+        last_id = records[-1][0] if records else 0
+        return [r for r in self.writing + self.pending if r[0] > last_id and match(r)]
+
+    @staticmethod
+    def _decode(records: List[Record]) -> List[Message]:
+        return [Message.from_json(payload) for _, _, payload in records]
+
+
+class ReplayCache(object):
+    """
+    Shares history reads between clients resuming from nearby message ids.
+    The log is read in pages of `page_size` ids on a worker thread, clients
+    asking for a page while it loads wait on the same read, and full pages
+    stay cached with their encoded frames
+    """
+
+    def __init__(self, log: MessageLog, **kwargs):
+        self.log = log
+        self.page_size = kwargs.get('page_size', 256)
+        self.max_pages = kwargs.get('max_pages', 64)
+        self.pages: "OrderedDict[int, List[Tuple[Message, str]]]" = OrderedDict()
+        self.loading: Dict[int, asyncio.Future] = {}
+
+    async def read(self, after_id: int) -> List[Tuple[Message, str]]:
+        """
+        Messages following `after_id` up to the end of its page
+        """
+        page = await self.page(after_id // self.page_size)
+        return [entry for entry in page if entry[0].message_id > after_id]
+
+    async def page(self, number: int) -> List[Tuple[Message, str]]:
+        page = self.pages.get(number)
+        if page is not None:
+            self.pages.move_to_end(number)
+            return page
+
+        future = self.loading.get(number)
+        if future is None:
+            future = self.loading[number] = asyncio.ensure_future(self._load(number))
+            future.add_done_callback(lambda _: self.loading.pop(number, None))
+        return await asyncio.shield(future)
+
+    async def _load(self, number: int) -> List[Tuple[Message, str]]:
+        loop = asyncio.get_event_loop()
+        # page `number` holds message ids number * page_size + 1 and on
+        records = await loop.run_in_executor(
+            None, self.log.read_records, number * self.page_size, self.page_size)
+        page = [(Message.from_json(payload), payload.decode()) for _, _, payload in records]
+        if len(page) == self.page_size:
+            # the tail page keeps growing, only full ones are worth keeping
+            self.pages[number] = page
+            if len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+        return page
+
+
+def from_env() -> Optional[MessageLog]:
+    """
+    CHAT_HISTORY_DIR, empty to keep no history, and CHAT_HISTORY_FLUSH in seconds
+    """
+    directory = os.environ.get('CHAT_HISTORY_DIR', 'history')
+    if not directory:
+        return None
+    return MessageLog(directory, flush_interval=float(os.environ.get('CHAT_HISTORY_FLUSH', 0.1)))
@@ -1,11 +1,20 @@
+from functools import lru_cache
 from typing import List, Any, Dict, Optional
 from pydantic import BaseModel
 import time
 import json
 
-class Message(BaseModel):
+FIELDS = (
+    "sender", "text", "action", "created_at", "sender_id",
+    "message_id", "reciepents", "reciepent_ids", "room",
+)
+
+_set = object.__setattr__
+
+
+class MessageModel(BaseModel):
     """
-    A message class for tranferring data between server and client
+    Validating twin of `Message` for input that is not trusted
     """
 
     sender: str = "System"
@@ -16,17 +25,116 @@ class Message(BaseModel):
     message_id:     Optional[int] = None
     reciepents:     Optional[List[str]] = None
     reciepent_ids:  Optional[List[str]] = None
+    room:           Optional[str] = None
+
+
+class Message(object):
+    """
+    A message class for tranferring data between server and client.
+    Construction does no validation and the json encoding is cached until
+    a field is assigned, use `validate` for input that is not trusted
+    """
+
+    __slots__ = FIELDS + ("_json",)
+
+    def __init__(self, sender: str = "System", text: str = "", action: str = "",
+                 created_at: int = 0, sender_id: str = None, message_id: Optional[int] = None,
+                 reciepents: Optional[List[str]] = None, reciepent_ids: Optional[List[str]] = None,
+                 room: Optional[str] = None):
+        _set(self, "sender", sender)
+        _set(self, "text", text)
+        _set(self, "action", action)
+        _set(self, "created_at", created_at)
+        _set(self, "sender_id", sender_id)
+        _set(self, "message_id", message_id)
+        _set(self, "reciepents", reciepents)
+        _set(self, "reciepent_ids", reciepent_ids)
+        _set(self, "room", room)
+        _set(self, "_json", None)
+
+    def __setattr__(self, name: str, value: Any):
+        _set(self, name, value)
+        # lists changed in place are not noticed, assign a new one instead
+        _set(self, "_json", None)
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, Message):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in FIELDS)
+
+    def __str__(self) -> str:
+        return " ".join(f"{name}={getattr(self, name)!r}" for name in FIELDS)
+
+    def __repr__(self) -> str:
+        return f"Message({', '.join(f'{name}={getattr(self, name)!r}' for name in FIELDS)})"
+
+    def __getstate__(self):
+        return self.dict()
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__init__(**state)
 
     @property
     def send_time(self) -> str:
-        time_arr = time.localtime(self.created_at)
-        time_str = time.strftime("%Y-%m-%d %H:%M:%S", time_arr)
-        return time_str
+        return _format_time(self.created_at)
+
+    def dict(self) -> Dict[str, Any]:
+        return {
+            "sender": self.sender,
+            "text": self.text,
+            "action": self.action,
+            "created_at": self.created_at,
+            "sender_id": self.sender_id,
+            "message_id": self.message_id,
+            "reciepents": self.reciepents,
+            "reciepent_ids": self.reciepent_ids,
+            "room": self.room,
+        }
+
+    def json(self) -> str:
+        data = self._json
+        if data is None:
+            data = json.dumps(self.dict())
+            _set(self, "_json", data)
+        return data
+
+    def copy(self, update: Optional[Dict[str, Any]] = None) -> "Message":
+        msg_dict = self.dict()
+        if update:
+            msg_dict.update(update)
+        return Message(**msg_dict)
+
+    @staticmethod
+    def validate(msg_dict: Dict[str, Any]) -> "Message":
+        """
+        Type check and coerce the fields, raises a ValueError, like
+        pydantic's ValidationError, for anything else
+        """
+        if not isinstance(msg_dict, dict):
+            raise ValueError(f'expected a json object, got {type(msg_dict).__name__}')
+        return Message(**MessageModel(**msg_dict).dict())
+
+    @staticmethod
+    def from_dict(msg_dict: Dict[str, Any]) -> "Message":
+        # unknown keys are ignored like the validating path does
+        return Message(*[msg_dict.get(name, default) for name, default in _DEFAULTS])
 
     @staticmethod
-    def from_json(msg_bytes):
+    def from_json(msg_bytes, validate: bool = False):
         msg_dict = json.loads(msg_bytes)
-        return Message(**msg_dict)
+        if validate:
+            return Message.validate(msg_dict)
+        return Message.from_dict(msg_dict)
+
+
+_DEFAULTS = tuple(zip(FIELDS, Message.__init__.__defaults__))
+
+
+@lru_cache(maxsize=4096)
+def _format_time(created_at: int) -> str:
+    # messages of a busy room share their second
+    time_arr = time.localtime(created_at)
+    return time.strftime("%Y-%m-%d %H:%M:%S", time_arr)
 
 if __name__ == '__main__':
     msg = Message(text="hello", sender="Bob")
@@ -38,3 +146,6 @@ if __name__ == '__main__':
 
     msg3 = Message.from_json(msg.json().encode())
     print(msg3)
+
+    msg4 = Message.from_json(msg.json(), validate=True)
+    print(msg4 == msg)
@@ -0,0 +1,220 @@
+import os
+import time
+import asyncio
+from bisect import bisect_left
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# seconds, from a fast local fan-out to a bot that takes its time
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+DEPTH_BUCKETS = (0, 1, 4, 16, 64, 256, 1024)
+
+
+class Meter(object):
+    """
+    A monotonic count. Marking is a plain integer add, the per second
+    rate is worked out from samples taken by `Registry.tick`
+    """
+
+    def __init__(self, name: str, help: str, window: int = 10):
+        self.name = name
+        self.help = help
+        self.count = 0
+        self.samples: Deque[Tuple[float, int]] = deque(maxlen=window + 1)
+
+    def mark(self, n: int = 1):
+        self.count += n
+
+    def sample(self, now: float):
+        self.samples.append((now, self.count))
+
+    def rate(self) -> float:
+        if len(self.samples) < 2:
+            return 0.0
+        (start, first), (end, last) = self.samples[0], self.samples[-1]
+        return (last - first) / (end - start) if end > start else 0.0
+
+    def expose(self) -> List[str]:
+        return [
+            f'# HELP {self.name}_total {self.help}',
+            f'# TYPE {self.name}_total counter',
+            f'{self.name}_total {self.count}',
+            f'# HELP {self.name}_per_second {self.help}, per second',
+            f'# TYPE {self.name}_per_second gauge',
+            f'{self.name}_per_second {self.rate():.3f}',
+        ]
+
+
+class Histogram(object):
+    """
+    Observations counted into fixed buckets, optionally split by one label
+    """
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS,
+                 label: Optional[str] = None):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.label = label
+        # label value -> counts per bucket, the last one past every bound
+        self.counts: Dict[str, List[int]] = {}
+        self.sums: Dict[str, float] = {}
+
+    def observe(self, value: float, label: str = ""):
+        counts = self.counts.get(label)
+        if counts is None:
+            counts = self.counts[label] = [0] * (len(self.buckets) + 1)
+            self.sums[label] = 0.0
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[label] += value
+
+    def expose(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for label, counts in self.counts.items():
+            labels = f'{self.label}="{label}",' if self.label else ''
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                lines.append(f'{self.name}_bucket{{{labels}le="{le}"}} {total}')
+            labels = f'{{{labels[:-1]}}}' if labels else ''
+            lines.append(f'{self.name}_sum{labels} {self.sums[label]:.6f}')
+            lines.append(f'{self.name}_count{labels} {total}')
+        return lines
+
+
+class Gauge(object):
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def expose(self) -> List[str]:
+        return [
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} gauge',
+            f'{self.name} {self.value:g}',
+        ]
+
+
+class LoopLagMonitor(object):
+    """
+    Sleeps `interval` seconds over and over and records how much later than
+    asked the loop woke it up, which is how long something held the loop
+    """
+
+    def __init__(self, histogram: Histogram, interval: float = 0.1):
+        self.histogram = histogram
+        self.interval = interval
+        self.name = 'chat_loop_lag_max_seconds'
+        # worst lag since the last scrape, and the latest, which admission control reads
+        self.worst = 0.0
+        self.last = 0.0
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - started - self.interval, 0.0)
+            self.histogram.observe(lag)
+            self.last = lag
+            if lag > self.worst:
+                self.worst = lag
+
+    def expose(self) -> List[str]:
+        worst, self.worst = self.worst, 0.0
+        return [
+            f'# HELP {self.name} worst event loop lag since the last scrape',
+            f'# TYPE {self.name} gauge',
+            f'{self.name} {worst:.6f}',
+        ]
+
+
+class Registry(object):
+    """
+    The metrics of this process, in prometheus text format
+    """
+
+    def __init__(self, **kwargs):
+        # seconds between rate samples
+        self.interval = kwargs.get('interval', 1.0)
+        self.metrics = []
+        self.tick_task: Optional[asyncio.Task] = None
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def meter(self, name: str, help: str) -> Meter:
+        return self.add(Meter(name, help))
+
+    def histogram(self, name: str, help: str, **kwargs) -> Histogram:
+        return self.add(Histogram(name, help, **kwargs))
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self.add(Gauge(name, help))
+
+    def start(self):
+        self.tick_task = asyncio.ensure_future(self.tick())
+        for metric in self.metrics:
+            if isinstance(metric, LoopLagMonitor):
+                metric.start()
+
+    def stop(self):
+        if self.tick_task:
+            self.tick_task.cancel()
+            self.tick_task = None
+        for metric in self.metrics:
+            if isinstance(metric, LoopLagMonitor):
+                metric.stop()
+
+    async def tick(self):
+        while True:
+            now = time.monotonic()
+            for metric in self.metrics:
+                if isinstance(metric, Meter):
+                    metric.sample(now)
+            await asyncio.sleep(self.interval)
+
+    def expose(self, extra: Iterable = ()) -> str:
+        lines = []
+        for metric in list(self.metrics) + list(extra):
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+messages_in = REGISTRY.meter('chat_messages_in', 'messages received from clients')
+messages_out = REGISTRY.meter('chat_messages_out', 'messages written to client sockets')
+frames_out = REGISTRY.meter('chat_frames_out', 'websocket frames written, a batch is one')
+# characters for text frames, which are utf-8 encoded by the socket
+bytes_out = REGISTRY.meter('chat_bytes_out', 'frame payload bytes written')
+fanout_seconds = REGISTRY.histogram(
+    'chat_fanout_seconds', 'time to encode and queue a routed message for its recipients',
+    label='route')
+connections_refused = REGISTRY.meter(
+    'chat_connections_refused', 'handshakes turned away at the connection cap or when overloaded')
+messages_limited = REGISTRY.meter('chat_messages_limited', 'messages dropped by a rate limit')
+bot_reply_seconds = REGISTRY.histogram(
+    'chat_bot_reply_seconds', 'time from dispatching a message to its bot reply', label='bot')
+loop_lag_seconds = REGISTRY.histogram(
+    'chat_loop_lag_seconds', 'how late the event loop ran a timer it was due to run')
+loop_lag = REGISTRY.add(LoopLagMonitor(
+    loop_lag_seconds, interval=float(os.environ.get('CHAT_LOOP_LAG_INTERVAL', 0.1))))
@@ -0,0 +1,61 @@
+import sys
+import time
+import threading
+from collections import Counter
+from typing import Optional
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stacks of a running thread, or all of them, from a helper
+    thread and counts them in the collapsed format flamegraph.pl and
+    speedscope read: `frame;frame;frame count`, outermost frame first
+    """
+
+    # one profile at a time per process
+    lock = threading.Lock()
+
+    def __init__(self, thread_id: Optional[int] = None, **kwargs):
+        # None samples every thread but the sampler itself
+        self.thread_id = thread_id
+        # seconds between samples
+        self.interval = kwargs.get('interval', 0.005)
+        self.stacks: Counter = Counter()
+        self.samples = 0
+
+    def run(self, seconds: float) -> str:
+        """
+        Sample for `seconds` and return the collapsed stacks, blocks the
+        calling thread, so call it from an executor
+        """
+        if not self.lock.acquire(blocking=False):
+            raise RuntimeError('a profile is already running')
+        try:
+            self.stacks.clear()
+            self.samples = 0
+            me = threading.get_ident()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                self.sample(me)
+                time.sleep(self.interval)
+            return self.collapsed()
+        finally:
+            self.lock.release()
+
+    def sample(self, me: int):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me or (self.thread_id is not None and thread_id != self.thread_id):
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if self.thread_id is None:
+                stack.append(names.get(thread_id, str(thread_id)))
+            self.stacks[';'.join(reversed(stack))] += 1
+        self.samples += 1
+
+    def collapsed(self) -> str:
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
@@ -0,0 +1,64 @@
+import time
+from typing import Dict, List, Optional
+
+
+class TokenBucket(object):
+    """
+    `rate` tokens a second up to `burst`, a take fails once they are spent
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, n: float = 1, now: Optional[float] = None) -> bool:
+        now = time.monotonic() if now is None else now
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        if self.tokens < n:
+            return False
+        self.tokens -= n
+        return True
+
+    def full(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class RateLimiter(object):
+    """
+    A token bucket per key, client id or token. Buckets that refilled are
+    forgotten now and then, a key coming back starts with a full one anyway.
+    A rate of 0 lets everything through
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None, **kwargs):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        # takes between sweeps of the refilled buckets
+        self.sweep_every = kwargs.get('sweep_every', 1024)
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.takes = 0
+        self.limited = 0
+
+    def allow(self, key: str, n: float = 1) -> bool:
+        if not self.rate:
+            return True
+        now = time.monotonic()
+        self.takes += 1
+        if self.takes % self.sweep_every == 0:
+            self.sweep(now)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+        if bucket.take(n, now):
+            return True
+        self.limited += 1
+        return False
+
+    def sweep(self, now: float):
+        idle: List[str] = [key for key, bucket in self.buckets.items() if bucket.full(now)]
+        for key in idle:
+            del self.buckets[key]
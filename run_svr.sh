@@ -1 +1,6 @@
-uvicorn server:app --host 0.0.0.0 --port 5555
+# WORKERS=4 sh run_svr.sh, workers share their messages over a unix socket backplane
+WORKERS=${WORKERS:-1}
+if [ "$WORKERS" -gt 1 ]; then
+    export CHAT_BACKPLANE=${CHAT_BACKPLANE:-/tmp/chat-backplane.sock}
+fi
+uvicorn server:app --host 0.0.0.0 --port 5555 --workers $WORKERS
@@ -1,9 +1,25 @@
-from typing import List, Union
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Union
+import os
+import hmac
+import logging
+import asyncio
+import threading
 import time
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, Query, Cookie
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, Query, Cookie, Header, HTTPException
+from fastapi.responses import HTMLResponse, PlainTextResponse
 from message import Message
+from connection import Connection
+import actions
+import backplane
+import codec
+import history
+import metrics
+from history import MessageLog, ReplayCache
+from bot import BotEngine, EchoBot
+from profiler import SamplingProfiler
+from ratelimit import RateLimiter
 
 app = FastAPI()
 
@@ -36,9 +52,12 @@ html = """
                 var ws_url = "ws://" + window.location.host + "/ws/" + client_id + "?token=" + token
                 ws = new WebSocket(ws_url)
                 ws.onmessage = function(event) {
+                    var msg = JSON.parse(event.data)
+                    if (msg.action) {
+                        return
+                    }
                     var messages = document.getElementById('messages')
                     var message = document.createElement('li')
-                    var msg = JSON.parse(event.data)
                     var content = document.createTextNode(msg.sender + ": " + msg.text)
                     message.appendChild(content)
                     messages.appendChild(message)
@@ -69,31 +88,376 @@ html = """
 
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+    def __init__(self, plane: Optional[backplane.Backplane] = None,
+                 log: Optional[MessageLog] = None, **kwargs):
+        # messages published by any worker come back through the backplane
+        self.backplane = plane or backplane.LocalBackplane()
+        self.history = log
+        self.replay = ReplayCache(log) if log else None
+        # a client resuming from further back only gets this many messages
+        self.max_replay = kwargs.pop('max_replay', 1000)
+        # users one multiplexed connection may carry
+        self.max_sessions = kwargs.pop('max_sessions', 1024)
+        # new connections are refused past this many, or while the loop lags
+        # more than shed_loop_lag seconds or this many frames wait to go
+        # out in all queues together, 0 turns a check off
+        self.max_connections = kwargs.pop('max_connections', 10000)
+        self.shed_loop_lag = kwargs.pop('shed_loop_lag', 0.5)
+        self.shed_queue_depth = kwargs.pop('shed_queue_depth', 100000)
+        self.queued = 0
+        self.queued_at = 0.0
+        self.refreshed_at = 0.0
+        # high_water, max_age, send_timeout and policy, see Connection
+        self.connection_options = kwargs
+        self.active_connections: Dict[WebSocket, Connection] = {}
+        # client_id -> sockets, one per device the user is connected from
+        self.clients: Dict[str, Set[Connection]] = defaultdict(set)
+        # room -> member sockets
+        self.rooms: Dict[str, Set[Connection]] = defaultdict(set)
+        self.evictions: Counter = Counter()
+        self.refusals: Counter = Counter()
+
+    async def start(self):
+        if self.history:
+            await self.history.start()
+        await self.backplane.start(self.on_published, last_id=self.last_id)
+
+    async def stop(self):
+        await self.backplane.close()
+        if self.history:
+            await self.history.close()
+
+    def last_id(self) -> int:
+        if not self.history:
+            return 0
+        # another worker may have kept the log until now
+        self.history.refresh()
+        return self.history.last_id
+
+    async def on_published(self, message: Message):
+        if self.history and self.backplane.is_broker:
+            self.history.append(message)
+        await self.route(message)
+
+    async def publish(self, message: Message):
+        """
+        Route a message to its recipients on every worker
+        """
+        await self.backplane.publish(message)
+
+    def overloaded(self) -> Optional[str]:
+        """
+        Why a new connection should be turned away, None to let it in
+        """
+        if self.max_connections and len(self.active_connections) >= self.max_connections:
+            return 'connections'
+        if self.shed_loop_lag and metrics.loop_lag.last > self.shed_loop_lag:
+            return 'loop_lag'
+        if self.shed_queue_depth:
+            now = time.monotonic()
+            # summed at most ten times a second, handshakes come in bursts
+            if now - self.queued_at >= 0.1:
+                self.queued = sum(c.depth for c in self.active_connections.values())
+                self.queued_at = now
+            if self.queued > self.shed_queue_depth:
+                return 'queue_depth'
+        return None
+
+    async def admit(self, websocket: WebSocket) -> bool:
+        """
+        Refuse the handshake when overloaded, before any work is spent on
+        the connection. Closing before accept rejects the upgrade with an
+        http 403, no close code reaches the client, which backs off and
+        tries again as after any failed connect
+        """
+        reason = self.overloaded()
+        if reason is None:
+            return True
+        self.refusals[reason] += 1
+        metrics.connections_refused.mark()
+        logging.debug(f'refused a connection: {reason}')
+        await websocket.close()
+        return False
+
+    async def connect(self, websocket: WebSocket, client_id: str = "", mux: bool = False) -> Connection:
+        wire, subprotocol = codec.negotiate(websocket.scope.get('subprotocols', []))
+        await websocket.accept(subprotocol=subprotocol)
+        connection = Connection(websocket, client_id, codec=wire, on_evict=self.evict, mux=mux,
+                                **self.connection_options)
+        self.active_connections[websocket] = connection
+        for user in connection.client_ids:
+            self.clients[user].add(connection)
+        return connection
+
+    def attach(self, connection: Connection, session: str) -> bool:
+        """
+        Let a multiplexed connection send and receive for one more user
+        """
+        if session in connection.client_ids:
+            return True
+        if not session or len(connection.client_ids) >= self.max_sessions:
+            return False
+        connection.client_ids.add(session)
+        connection.session_rooms[session] = set()
+        self.clients[session].add(connection)
+        return True
+
+    def detach(self, connection: Connection, session: str) -> Set[str]:
+        """
+        Drop a session from a multiplexed connection, returns the rooms it was in
+        """
+        if session not in connection.client_ids:
+            return set()
+        rooms = set(connection.session_rooms.get(session, ()))
+        for room in rooms:
+            self.leave(connection, room, session)
+        connection.client_ids.discard(session)
+        connection.session_rooms.pop(session, None)
+        self._discard(self.clients, session, connection)
+        return rooms
 
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
+    async def resume(self, connection: Connection, last_id: Optional[int] = None):
+        """
+        Send the client what it missed after `last_id`, then go live.
+        Frames routed meanwhile wait in the connection queue
+        """
+        if self.history and last_id is not None:
+            self.refresh_history()
+            after_id = max(last_id, self.history.last_id - self.max_replay)
+            # an id past the log's head comes from another log, say one the
+            # server was started without, skipping live frames up to it loses them
+            after_id = min(after_id, self.history.last_id)
+            retries = 3
+            while True:
+                page = await self.replay.read(after_id)
+                if page:
+                    frames = [
+                        data if connection.codec.key == codec.JSON.key else connection.codec.encode(message)
+                        for message, data in page if self.visible(message, connection)
+                    ]
+                    if connection.codec.batch and frames:
+                        frames = [connection.codec.encode_batch(frames)]
+                    try:
+                        for data in frames:
+                            if isinstance(data, bytes):
+                                await connection.websocket.send_bytes(data)
+                            else:
+                                await connection.websocket.send_text(data)
+                    except Exception:
+                        # the receive loop of the endpoint notices the disconnect
+                        return
+                    after_id = page[-1][0].message_id
+                    continue
+
+                first_live = connection.first_queued_id()
+                if first_live is None or first_live <= after_id + 1 or not retries:
+                    break
+                # the broker's worker has not flushed the gap to the log yet
+                retries -= 1
+                await asyncio.sleep(self.history.flush_interval)
+                self.refresh_history()
+            connection.replayed_id = after_id
+        # caught up, the client may show itself online
+        connection.push(actions.control_frame(actions.CONNECTION_ENABLE, connection.codec))
+        connection.start()
+
+    def refresh_history(self):
+        if self.backplane.is_broker:
+            return
+        now = time.monotonic()
+        if now - self.refreshed_at >= self.history.flush_interval:
+            self.refreshed_at = now
+            self.history.refresh()
+
+    @staticmethod
+    def visible(message: Message, connection: Connection) -> bool:
+        """
+        Whether `route` would have delivered the message to the connection
+        """
+        if message.reciepent_ids or message.reciepents:
+            return not connection.client_ids.isdisjoint((message.reciepent_ids or []) + (message.reciepents or []))
+        if message.room:
+            return message.room in connection.rooms
+        return True
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        connection = self.active_connections.pop(websocket, None)
+        if not connection:
+            return
+        connection.close()
+        for user in connection.client_ids:
+            self._discard(self.clients, user, connection)
+        for room in connection.rooms:
+            self._discard(self.rooms, room, connection)
+
+    @staticmethod
+    def _discard(index: Dict[str, Set[Connection]], key: str, connection: Connection):
+        members = index.get(key)
+        if members is None:
+            return
+        members.discard(connection)
+        if not members:
+            del index[key]
+
+    def join(self, connection: Connection, room: str, session: Optional[str] = None):
+        if session is not None:
+            connection.session_rooms[session].add(room)
+        connection.rooms.add(room)
+        self.rooms[room].add(connection)
+
+    def leave(self, connection: Connection, room: str, session: Optional[str] = None):
+        if session is not None:
+            connection.session_rooms[session].discard(room)
+            if any(room in rooms for rooms in connection.session_rooms.values()):
+                return
+        connection.rooms.discard(room)
+        self._discard(self.rooms, room, connection)
+
+    def evict(self, connection: Connection, reason: str):
+        self.evictions[connection.client_id] += 1
+        self.disconnect(connection.websocket)
+
+    def stats(self) -> dict:
+        return {
+            "connections": [c.stats() for c in self.active_connections.values()],
+            "rooms": {room: len(members) for room, members in self.rooms.items()},
+            "evictions": dict(self.evictions),
+            "refusals": dict(self.refusals),
+        }
+
+    def gauges(self) -> list:
+        """
+        Gauges of the current connections, built when scraped
+        """
+        active = metrics.Gauge('chat_connections', 'open websocket connections')
+        active.set(len(self.active_connections))
+        depth = metrics.Histogram('chat_connection_queue_depth', 'frames waiting per connection',
+                                  buckets=metrics.DEPTH_BUCKETS)
+        for connection in self.active_connections.values():
+            depth.observe(connection.depth)
+        evicted = metrics.Gauge('chat_evictions', 'slow consumers disconnected')
+        evicted.set(sum(self.evictions.values()))
+        return [active, depth, evicted]
 
     async def send_personal_message(self, message: Message, websocket: WebSocket):
-        await websocket.send_text(message.json())
+        connection = self.active_connections.get(websocket)
+        if connection:
+            connection.push_message(message, {})
+
+    async def send_to_clients(self, message: Message, client_ids: Iterable[str]):
+        started = time.perf_counter()
+        frames = {}
+        # a multiplexed connection gets the message once for all its addressed users
+        connections = set()
+        for client_id in set(client_ids):
+            connections.update(self.clients.get(client_id, ()))
+        for connection in connections:
+            connection.push_message(message, frames)
+        metrics.fanout_seconds.observe(time.perf_counter() - started, 'clients')
+
+    async def send_to_room(self, message: Message, room: str):
+        started = time.perf_counter()
+        frames = {}
+        for connection in list(self.rooms.get(room, ())):
+            connection.push_message(message, frames)
+        metrics.fanout_seconds.observe(time.perf_counter() - started, 'room')
 
     async def broadcast(self, message: Message):
-        for connection in self.active_connections:
-            await connection.send_text(message.json())
+        started = time.perf_counter()
+        # encode once per codec, every writer task sends the same frame concurrently
+        frames = {}
+        # a push may evict, which drops the connection from the indexes
+        for connection in list(self.active_connections.values()):
+            connection.push_message(message, frames)
+        metrics.fanout_seconds.observe(time.perf_counter() - started, 'broadcast')
 
+    async def route(self, message: Message):
+        """
+        Deliver to the addressed clients, else to the room, else to everyone.
+        The client_id in the url is the user name, so `reciepents` and
+        `reciepent_ids` address the same index
+        """
+        if message.reciepent_ids or message.reciepents:
+            await self.send_to_clients(message, (message.reciepent_ids or []) + (message.reciepents or []))
+        elif message.room:
+            await self.send_to_room(message, message.room)
+        else:
+            await self.broadcast(message)
 
-manager = ConnectionManager()
 
+manager = ConnectionManager(
+    backplane.from_env(), history.from_env(),
+    max_connections=int(os.environ.get('CHAT_MAX_CONNECTIONS', 10000)),
+    shed_loop_lag=float(os.environ.get('CHAT_SHED_LOOP_LAG', 0.5)),
+    shed_queue_depth=int(os.environ.get('CHAT_SHED_QUEUE_DEPTH', 100000)),
+)
+
+# messages a second and burst per user, and per token shared by every
+# connection presenting it, 0 turns a limit off
+client_limits = RateLimiter(
+    float(os.environ.get('CHAT_RATE', 20)), float(os.environ.get('CHAT_BURST', 40)))
+token_limits = RateLimiter(
+    float(os.environ.get('CHAT_TOKEN_RATE', 0)), float(os.environ.get('CHAT_TOKEN_BURST', 0)))
+
+bots = BotEngine(
+    executor=os.environ.get('CHAT_BOT_EXECUTOR', 'thread'),
+    max_workers=int(os.environ.get('CHAT_BOT_WORKERS', 4)),
+)
+bots.register(EchoBot(), default=True)
+
+# the admin endpoints are off unless a token is set
+admin_token = os.environ.get('CHAT_ADMIN_TOKEN', '')
+# the thread running the event loop, what the profiler samples by default
+loop_thread_id: Optional[int] = None
+
+
+@app.on_event("startup")
+async def startup():
+    global loop_thread_id
+    loop_thread_id = threading.get_ident()
+    metrics.REGISTRY.start()
+    await manager.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await manager.stop()
+    bots.shutdown()
+    metrics.REGISTRY.stop()
 
 @app.get("/")
 async def get():
     return HTMLResponse(html)
 
+@app.get("/connections")
+async def connections():
+    return manager.stats()
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.REGISTRY.expose(manager.gauges()))
+
+def check_admin(x_admin_token: Union[str, None] = Header(default=None)):
+    if not admin_token:
+        raise HTTPException(status_code=404)
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, admin_token):
+        raise HTTPException(status_code=403, detail='admin token required')
+
+@app.get("/admin/profile", dependencies=[Depends(check_admin)])
+async def profile(seconds: float = Query(default=5, gt=0, le=60),
+                  interval: float = Query(default=0.005, ge=0.001, le=1),
+                  threads: str = Query(default='loop', regex='^(loop|all)$')):
+    """
+    Sample this worker's stacks for `seconds` and return them collapsed,
+    ready for flamegraph.pl or speedscope. `threads=all` adds the bot pool
+    """
+    sampler = SamplingProfiler(loop_thread_id if threads == 'loop' else None, interval=interval)
+    loop = asyncio.get_event_loop()
+    try:
+        stacks = await loop.run_in_executor(None, sampler.run, seconds)
+    except RuntimeError as err:
+        raise HTTPException(status_code=409, detail=str(err))
+    return PlainTextResponse(stacks)
+
 async def get_cookie_or_token(
         websocket: WebSocket,
         sid: Union[str, None] = Cookie(default=None),
@@ -104,24 +468,144 @@ async def get_cookie_or_token(
 #        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
     return sid, token
 
+def within_limits(client_id: str, token: Optional[str]) -> bool:
+    """
+    Take a message from the user's and the token's buckets, a message past
+    either limit is dropped before it costs a broadcast
+    """
+    if client_limits.allow(client_id) and (token is None or token_limits.allow(token)):
+        return True
+    metrics.messages_limited.mark()
+    return False
+
+async def receive_messages(connection: Connection) -> List[Message]:
+    """
+    The messages of the next frame, more than one if it is a batch
+    """
+    frame = await connection.websocket.receive()
+    if frame["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(frame["code"])
+    # frames from clients are not trusted, json goes through validation,
+    # binary frames only parse into well typed fields
+    if frame.get("bytes") is not None:
+        return codec.BINARY.decode_frames(frame["bytes"], validate=True)
+    return codec.JSON.decode_frames(frame["text"], validate=True)
+
+async def handle_message(connection: Connection, msg: Message, client_id: Optional[str] = None):
+    """
+    Act on a message from `client_id`, the connection's user unless it is multiplexed
+    """
+    client_id = client_id or connection.client_id
+    session = client_id if connection.mux else None
+    if msg.action == actions.JOIN and msg.room:
+        manager.join(connection, msg.room, session)
+        return
+    if msg.action == actions.LEAVE and msg.room:
+        manager.leave(connection, msg.room, session)
+        return
+
+    reciepent_ids = None
+    if msg.reciepent_ids or msg.reciepents:
+        # echo to the sender's other devices as well
+        reciepent_ids = (msg.reciepent_ids or []) + (msg.reciepents or []) + [client_id]
+    await manager.publish(Message(
+        text=f'#{client_id}:' + msg.text,
+        created_at=int(time.time()),
+        sender_id=client_id,
+        room=msg.room,
+        reciepent_ids=reciepent_ids,
+    ))
+
+    async def reply(bot_msg: Message):
+        if session is not None:
+            # tell the multiplexing client which of its users the reply is for
+            bot_msg.reciepent_ids = [session]
+        await manager.send_personal_message(bot_msg, connection.websocket)
+    bots.dispatch(msg, reply)
+
+async def announce_left(client_id: str, rooms: Iterable[str]):
+    msg = Message(text=f'#{client_id} left the chat', created_at=int(time.time()))
+    if not rooms:
+        await manager.publish(msg)
+    for left_room in rooms:
+        await manager.publish(msg.copy(update={"room": left_room}))
+
 @app.websocket("/ws/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: str,
-        sid_or_token: str = Depends(get_cookie_or_token)):
-    await manager.connect(websocket)
+        sid_or_token: str = Depends(get_cookie_or_token),
+        room: Union[str, None] = Query(default=None),
+        last_id: Union[int, None] = Query(default=None)):
+    if not await manager.admit(websocket):
+        return
+    connection = await manager.connect(websocket, client_id)
     sid, token = sid_or_token
     token = token or sid
     print(f'token:{token}')
+    # whatever ends the connection, it leaves the indexes with its writer
     try:
+        if room:
+            manager.join(connection, room)
+        await manager.resume(connection, last_id)
         while True:
-            data = await websocket.receive_text()
-            msg = Message.from_json(data)
-            await manager.broadcast(Message(text=f'#{client_id}:' + msg.text, created_at=int(time.time())))
-            msg.sender = "Bot"
-            msg.text = 'reply: ' + msg.text
-            msg.created_at = int(time.time())
-            await manager.send_personal_message(msg, websocket)
+            try:
+                msgs = await receive_messages(connection)
+            except ValueError:
+                # skip malformed frames, the socket stays usable
+                continue
+            metrics.messages_in.mark(len(msgs))
+            for msg in msgs:
+                if within_limits(client_id, token):
+                    await handle_message(connection, msg)
     except WebSocketDisconnect:
+        pass
+    finally:
+        rooms = list(connection.rooms)
         manager.disconnect(websocket)
-        msg = Message(text=f'#{client_id} left the chat', created_at=int(time.time()))
-        await manager.broadcast(msg)
+        await announce_left(client_id, rooms)
 
+@app.websocket("/mux/{client_id}")
+async def mux_endpoint(websocket: WebSocket, client_id: str,
+        sid_or_token: str = Depends(get_cookie_or_token),
+        sessions: str = Query(default=""),
+        last_id: Union[int, None] = Query(default=None)):
+    """
+    One connection for many users. Every message names its user in
+    `sender_id`, users are attached with the `sessions` query parameter, a
+    comma separated list, or later with an "attach" action, and dropped
+    with "detach". Deliveries go out once per connection, the client hands
+    them to its users the way `ConnectionManager.visible` picks them
+    """
+    if not await manager.admit(websocket):
+        return
+    connection = await manager.connect(websocket, client_id, mux=True)
+    sid, token = sid_or_token
+    token = token or sid
+    try:
+        for session in filter(None, sessions.split(',')):
+            manager.attach(connection, session)
+        await manager.resume(connection, last_id)
+        while True:
+            try:
+                msgs = await receive_messages(connection)
+            except ValueError:
+                continue
+            metrics.messages_in.mark(len(msgs))
+            for msg in msgs:
+                session = msg.sender_id
+                if msg.action in (actions.ATTACH, actions.DETACH):
+                    # session churn counts against the connection, every detach is a broadcast
+                    if not within_limits(client_id, token):
+                        continue
+                    if msg.action == actions.ATTACH:
+                        manager.attach(connection, session)
+                    elif session in connection.client_ids:
+                        await announce_left(session, manager.detach(connection, session))
+                elif session in connection.client_ids and within_limits(session, token):
+                    await handle_message(connection, msg, session)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sessions = {session: set(rooms) for session, rooms in connection.session_rooms.items()}
+        manager.disconnect(websocket)
+        for session, rooms in sessions.items():
+            await announce_left(session, rooms)
@@ -1,6 +1,5 @@
 import logging
 import asyncio
-import time
 import aioconsole
 
 from message import Message
@@ -63,9 +62,8 @@ def test_multi_event_loop():
     async def output(client):
         while True:
             try:
-                msg = client.recv()
+                msg = await cur_loop.run_in_executor(None, client.recv, 1)
                 if not msg:
-                    await asyncio.sleep(0.1)
                     continue
                 print(f">> {msg}")
             except Exception as err:
@@ -92,14 +90,28 @@ def test_sync():
         print(f"<< {msg}")
         client.send(msg)
 
-        recv_retry = 50
-        for _ in range(recv_retry):
-            msg = client.recv()
+        # wakes as soon as a message arrives, gives up after a quiet second
+        while True:
+            msg = client.recv(timeout=1)
             if not msg:
-                time.sleep(0.1)
-                continue
+                break
             print(f">> {msg}")
 
+def test_callback():
+    user_name = "bob"
+    url = "ws://localhost:5555"
+    client = WsClient(user_name, url, loop=asyncio.new_event_loop(),
+                      on_message=lambda msg: print(f">> {msg}"))
+    client.start()
+    while True:
+        text = input(f"<<")
+        msg = Message(
+            sender=user_name,
+            text=text
+        )
+        print(f"<< {msg}")
+        client.send(msg)
+
 def main():
     import sys
     import inspect